@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of test configs expansion: deep copies of parameters vs layered ParamsView.
+
+Usage: python benchmarks/params_bench.py [--tests N] [--runs N] [--blob-size N]
+"""
+
+import argparse
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+from params import ParamsView
+
+def make_suite(tests_count, runs_count, blob_size):
+    dataset = [{"key": "key-{0}".format(i), "value": "x" * 32} for i in xrange(blob_size)]
+    suite = {}
+    for test in xrange(tests_count):
+        suite["test_{0}".format(test)] = {
+            "params": {"dataset": dataset, "threads": 4},
+            "runs": [{"path": "run.cfg", "params": {"iteration": run}}
+                     for run in xrange(runs_count)]}
+    return suite
+
+def expand_with_copies(suite, overrides):
+    """Copies parameters the way configs were expanded before ParamsView."""
+    tests = copy.deepcopy(suite)
+    expanded = []
+    for name, cfg in tests.items():
+        cfg["params"].update(overrides.get(name, {}))
+        for run in cfg["runs"]:
+            params = copy.deepcopy(cfg["params"])
+            params.update(run["params"])
+            variables = copy.deepcopy(params)
+            extra_vars = copy.deepcopy(run["params"])
+            expanded.append((copy.deepcopy(run), variables, extra_vars))
+    return expanded
+
+def expand_with_views(suite, overrides):
+    expanded = []
+    for name, cfg in suite.items():
+        for run in cfg["runs"]:
+            params = ParamsView(overrides.get("_global"), cfg["params"],
+                                run["params"], overrides.get(name))
+            variables = dict(params)
+            extra_vars = dict(run["params"])
+            expanded.append((dict(run), variables, extra_vars))
+    return expanded
+
+def _memory_kb(field):
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field):
+                return int(line.split()[1])
+    return 0
+
+def measure(func, suite, overrides):
+    """Runs func in a child process; returns its time (s) and memory growth (KB)."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        rss = _memory_kb("VmRSS")
+        started = time.time()
+        func(suite, overrides)
+        elapsed = time.time() - started
+        os.write(write_fd, "{0} {1}".format(elapsed, _memory_kb("VmHWM") - rss))
+        os._exit(0)
+
+    os.close(write_fd)
+    result = os.read(read_fd, 1024)
+    os.waitpid(pid, 0)
+    elapsed, memory = result.split()
+    return float(elapsed), int(memory)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tests', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--blob-size', type=int, default=5000, dest="blob_size")
+    args = parser.parse_args()
+
+    suite = make_suite(args.tests, args.runs, args.blob_size)
+    overrides = {"_global": {"log_level": "info"}, "test_0": {"threads": 8}}
+
+    print("{0} tests x {1} runs, dataset of {2} items".format(args.tests, args.runs,
+                                                             args.blob_size))
+    for name, func in [("deep copies", expand_with_copies), ("params views", expand_with_views)]:
+        elapsed, memory = measure(func, suite, overrides)
+        print("{0:>14}: {1:8.3f}s {2:10} KB".format(name, elapsed, memory))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Tests run aborting module.
+
+The run can be aborted (e.g. when too many tests failed or the process got SIGTERM)
+and a guarded block can be given a time budget. In both cases running subprocesses
+(playbooks, pytest sessions) of the guarded block are terminated and the main thread
+is interrupted. Unguarded code (e.g. teardown) isn't interrupted.
+
+Interrupted blocks raise Aborted exception:
+    >>> with aborting.guard(budget=600):
+    ...     run_test()
+    ...
+    TimeBudgetExceeded: time budget of 600s is exceeded
+
+"""
+
+import os
+import time
+import signal
+import threading
+
+import processes
+
+# Signal which interrupts the main thread when a time budget is exceeded
+INTERRUPT_SIGNAL = signal.SIGUSR1
+
+_reason = None
+# active guards (guards are used only in the main thread)
+_guards = []
+# guard which time budget is exceeded
+_exceeded_guard = None
+_lock = threading.RLock()
+
+class Aborted(Exception):
+    pass
+
+class TimeBudgetExceeded(Aborted):
+    pass
+
+def get_reason():
+    """Returns the reason why the run was aborted (None if it wasn't)."""
+    return _reason
+
+def _is_guarded():
+    return bool(_guards) and _guards[-1].active
+
+def abort(reason):
+    """Aborts the run: subprocesses of the guarded block are terminated
+    and guarded blocks can't be entered anymore.
+    """
+    global _reason
+    with _lock:
+        if _reason is None:
+            _reason = reason
+        guarded = bool(_guards)
+    if guarded:
+        processes.terminate_all()
+
+def handle_sigterm(on_abort=None):
+    """Aborts the run on SIGTERM (the guarded block is interrupted).
+
+    on_abort -- function which is called on SIGTERM (e.g. to stop child processes)
+    """
+    def handler(signum, frame):
+        abort("the run was terminated")
+        if on_abort:
+            on_abort()
+        # signal handlers are called in the main thread, so the check isn't racy
+        if _is_guarded():
+            raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, handler)
+
+def _interrupt_handler(signum, frame):
+    guard = _exceeded_guard
+    if guard is not None and guard.active:
+        raise KeyboardInterrupt()
+
+class guard(object):
+    """Converts interruption of the block (by SIGTERM or exceeded time budget)
+    into Aborted exception.
+
+    budget -- seconds the block can take (None for unlimited)
+    started -- time the budget is counted from (the budget can be shared by several blocks,
+               e.g. by setups and runs of a test); the block is entered only if the budget
+               isn't exceeded yet
+    """
+    def __init__(self, budget=None, started=None):
+        self.budget = budget
+        self.started = started
+
+    def _exceed(self):
+        global _exceeded_guard
+        with _lock:
+            if not self.active:
+                return
+            self.exceeded = True
+            _exceeded_guard = self
+        processes.terminate_all()
+        # the main thread is interrupted by the signal handler
+        # only if the block isn't finished yet
+        os.kill(os.getpid(), INTERRUPT_SIGNAL)
+
+    def __enter__(self):
+        if _reason is not None:
+            raise Aborted(_reason)
+        remaining = self.budget
+        if self.budget and self.started is not None:
+            remaining = self.budget - (time.time() - self.started)
+            if remaining <= 0:
+                raise TimeBudgetExceeded("time budget of {0}s is exceeded".format(self.budget))
+        if self.budget:
+            signal.signal(INTERRUPT_SIGNAL, _interrupt_handler)
+        self.active = True
+        self.exceeded = False
+        self.timer = None
+        with _lock:
+            _guards.append(self)
+        if self.budget:
+            self.timer = threading.Timer(remaining, self._exceed)
+            self.timer.daemon = True
+            self.timer.start()
+        return self
+
+    def _deactivate(self):
+        with _lock:
+            self.active = False
+            if _guards and _guards[-1] is self:
+                _guards.pop()
+
+    def __exit__(self, type, value, traceback):
+        try:
+            self._deactivate()
+        except KeyboardInterrupt:
+            # the interruption was delivered just at the end of the block
+            self._deactivate()
+            type = KeyboardInterrupt
+        if self.timer:
+            self.timer.cancel()
+
+        # the block could be finished before the interruption was delivered
+        if self.exceeded:
+            raise TimeBudgetExceeded("time budget of {0}s is exceeded".format(self.budget))
+        if _reason is not None and (type is None or issubclass(type, KeyboardInterrupt)):
+            raise Aborted(_reason)
@@ -1,36 +1,136 @@
 import os
-import sys
+import re
 import json
-import subprocess
+import hashlib
+import time
+import itertools
 import ConfigParser
 
+from collections import namedtuple
+
 import openstack
+import processes
 import teamcity_messages
 
+# Directory for playbooks' logs (logs aren't kept if it's None)
+LOGS_DIR = None
+
+# Ansible 1.x prints "TASK: [name] ***", ansible 2.x prints "TASK [name] ***"
+TASK_RE = re.compile(r"^TASK:? \[(?P<name>.*)\]")
+
+# Files and directories near a playbook which can change its result
+PLAYBOOK_DEPENDENCIES = ["roles", "tasks", "handlers", "templates", "files", "vars", "library",
+                         "filter_plugins", "group_vars/all", "group_vars/all.yml",
+                         "group_vars/all.json", "host_vars"]
+
+PlaybookResult = namedtuple("PlaybookResult",
+                            ["name", "exitcode", "duration", "tasks", "log_path"])
+
+_log_number = itertools.count(1)
+
 class AnsiblePlaybookError(Exception):
     pass
 
 def set_vars(vars_path, params):
-    with open(vars_path, 'w') as f:
-        json.dump(params, f)
-
-def run_playbook(playbook, inventory, extra_vars={}):
-    tc_block = "ANSIBLE: {}({})".format(os.path.basename(playbook), os.path.basename(inventory))
+    # write to a temporary file and rename it, so concurrent testrunners
+    # (e.g. in sharding mode) never read a partially written file
+    tmp_path = "{0}.{1}.tmp".format(vars_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(params), f)
+    os.rename(tmp_path, vars_path)
+
+def _get_playbook_name(playbook, inventory):
+    return "{}({})".format(os.path.basename(playbook), os.path.basename(inventory))
+
+class _PlaybookOutput(object):
+    """Collects playbook's output: keeps the log and measures tasks' durations."""
+    def __init__(self, name):
+        self.started = time.time()
+        self.tasks = []
+        self._task = None
+        self._task_started = None
+        self.log_path = None
+        self._log = None
+        if LOGS_DIR:
+            if not os.path.exists(LOGS_DIR):
+                os.makedirs(LOGS_DIR)
+            log_name = "ansible-{}-{:03}-{}.log".format(os.getpid(), next(_log_number), name)
+            self.log_path = os.path.join(LOGS_DIR, log_name)
+            self._log = open(self.log_path, 'w')
+
+    def _finish_task(self):
+        if self._task is not None:
+            self.tasks.append((self._task, time.time() - self._task_started))
+            self._task = None
+
+    def add_line(self, line):
+        if self._log:
+            self._log.write(line)
+
+        match = TASK_RE.match(line)
+        if match or line.startswith("PLAY"):
+            self._finish_task()
+        if match:
+            self._task = match.group("name")
+            self._task_started = time.time()
+
+    def get_result(self, name, exitcode):
+        self._finish_task()
+        if self._log:
+            self._log.close()
+        return PlaybookResult(name=name, exitcode=exitcode,
+                              duration=time.time() - self.started,
+                              tasks=self.tasks, log_path=self.log_path)
+
+def run_playbooks(playbooks):
+    """Runs playbooks concurrently; returns a list of PlaybookResult.
+
+    playbooks -- list of tuples (playbook, inventory, extra_vars, limit);
+                 limit is a list of hosts to run the playbook on (None for all hosts)
+    """
+    names = []
+    commands = {}
+    outputs = {}
+    for playbook, inventory, extra_vars, limit in playbooks:
+        name = _get_playbook_name(playbook, inventory)
+        if name in commands:
+            name += "#{}".format(len(names))
+        names.append(name)
+        commands[name] = ["ansible-playbook", "-v",
+                          "--extra-vars", json.dumps(extra_vars),
+                          "--inventory-file", inventory,
+                          "{}.yml".format(playbook)]
+        if limit is not None:
+            commands[name] += ["--limit", ",".join(limit)]
+        outputs[name] = _PlaybookOutput(name)
+
+    def format_line(name, line):
+        if len(commands) == 1:
+            return line
+        flow_line = teamcity_messages.add_flow_id(line, name)
+        if flow_line is not None:
+            return flow_line
+        return "[{0}] {1}".format(name, line)
+
+    exitcodes = processes.run_concurrently(commands, format_line,
+                                           on_line=lambda name, line: outputs[name].add_line(line))
+
+    return [outputs[name].get_result(name, exitcodes[name]) for name in names]
+
+def run_playbook(playbook, inventory, extra_vars={}, limit=None):
+    """Runs the playbook and returns PlaybookResult
+    (raises AnsiblePlaybookError if the playbook failed).
+    """
+    tc_block = "ANSIBLE: {}".format(_get_playbook_name(playbook, inventory))
     with teamcity_messages.block(tc_block):
-        extra_vars_qjson = json.dumps(extra_vars)
-        cmd = "ansible-playbook -v --extra-vars='{}' --inventory-file {} {}.yml"
-        cmd = cmd.format(extra_vars_qjson, inventory, playbook)
-
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-
-        for line in iter(process.stdout.readline, ''):
-            sys.stdout.write(line)
+        result = run_playbooks([(playbook, inventory, extra_vars, limit)])[0]
 
-        process.wait()
-        if process.returncode:
-            error_msg = "Playbook {} failed (exit code: {})".format(playbook, process.returncode)
+        if result.exitcode:
+            error_msg = "Playbook {} failed (exit code: {})".format(playbook, result.exitcode)
             raise AnsiblePlaybookError(error_msg)
 
+        return result
+
 def generate_inventory(inventory_path, clients_count, servers_per_group,
                        groups, instances_names, ssh_user):
     inventory_host_record_template = '{host} ansible_ssh_user={user}'
@@ -97,6 +197,51 @@ def get_host_names(instance_name, count):
         result = openstack.utils.get_instances_names_from_conf(config)
     return result
 
+def _get_files(path):
+    """Returns sorted paths of files in the directory tree (or the file itself)."""
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        files.extend(os.path.join(dirpath, name) for name in sorted(filenames))
+    return files
+
+def get_fingerprint(playbook, extra_vars, files_paths=()):
+    """Returns fingerprint of playbook's contents (with the files it can use:
+    roles, tasks, templates, common vars, etc.), extra vars and given files
+    (vars files, inventory).
+    """
+    playbook_dir = os.path.dirname(playbook)
+    paths = ["{}.yml".format(playbook)]
+    for name in PLAYBOOK_DEPENDENCIES:
+        paths.extend(_get_files(os.path.join(playbook_dir, name)))
+    paths.extend(files_paths)
+
+    fingerprint = hashlib.sha1()
+    for path in paths:
+        if os.path.exists(path):
+            fingerprint.update(os.path.relpath(path, playbook_dir))
+            with open(path) as f:
+                fingerprint.update(f.read())
+    fingerprint.update(json.dumps(extra_vars, sort_keys=True))
+    return fingerprint.hexdigest()
+
+def get_host_fingerprint(fingerprint, host, ssh_user):
+    """Returns fingerprint of the playbook run on the host."""
+    return hashlib.sha1("{} {} {}".format(fingerprint, host, ssh_user)).hexdigest()
+
+def read_stamps(stamps_path):
+    """Returns dictionary: **host**: **fingerprint of the last successful run**."""
+    if not os.path.exists(stamps_path):
+        return {}
+    with open(stamps_path) as stamps_file:
+        return json.load(stamps_file)
+
+def write_stamps(stamps_path, stamps):
+    with open(stamps_path, 'w') as stamps_file:
+        json.dump(stamps, stamps_file, indent=4)
+
 def _get_groups_names(name):
     groups = {"clients": "clients-{0}".format(name),
               "servers": "servers-{0}".format(name),
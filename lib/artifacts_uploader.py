@@ -0,0 +1,122 @@
+"""Artifacts uploading module.
+
+This module uploads files to the file storage concurrently (with a bounded pool
+of threads sharing keep-alive connections). Files are streamed from disk
+(optionally gzip-compressed on the fly), failed uploads are retried with backoff
+and uploaded files are checked to be available by returned URLs.
+
+"""
+
+import os
+import time
+import zlib
+import logging
+
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+STORAGE_URL = "http://qa-storage.yandex-team.ru"
+UPLOAD_PATH = "elliptics-testing"
+
+UPLOAD_THREADS = 4
+RETRIES = 3
+RETRY_BACKOFF = 2
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = 60
+
+class UploadError(Exception):
+    pass
+
+def get_upload_url(storage, build_name, build_number, file_name):
+    url = '{storage}/upload/{path}/{build_name}/{build_number}/{file_name}'
+    return url.format(storage=storage, path=UPLOAD_PATH, build_name=build_name.replace(' ', '_'),
+                      build_number=build_number, file_name=file_name)
+
+class _CompressedFile(object):
+    """Gzip-compressed file's content iterated by chunks (counts the compressed size)."""
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+
+    def __iter__(self):
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                data = compressor.compress(chunk)
+                if data:
+                    self.size += len(data)
+                    yield data
+        data = compressor.flush()
+        self.size += len(data)
+        yield data
+
+def upload(http, path, url, compress=False, retries=RETRIES):
+    """Uploads the file and returns a tuple: (**URL to get it**, **uploaded size**)
+    (raises UploadError if the file isn't available after all attempts).
+    """
+    get_url = url.replace("/upload/", "/get/")
+    for attempt in xrange(retries + 1):
+        if attempt:
+            time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+        try:
+            if compress:
+                data = _CompressedFile(path)
+                r = http.post(url, data=data, timeout=TIMEOUT)
+                size = data.size
+            else:
+                with open(path, 'rb') as f:
+                    r = http.post(url, data=f, timeout=TIMEOUT)
+                    size = os.fstat(f.fileno()).st_size
+            r.raise_for_status()
+
+            # check that the file is available
+            r = http.get(get_url, stream=True, timeout=TIMEOUT)
+            r.close()
+            r.raise_for_status()
+            return get_url, size
+        except requests.RequestException as e:
+            error = e
+
+    raise UploadError("Failed to upload {0}: {1}".format(path, error))
+
+def upload_artifacts(paths, build_name, build_number, storage=STORAGE_URL,
+                     threads=UPLOAD_THREADS, compress=False):
+    """Uploads files concurrently and returns dictionary: **path**: **URL** (None if failed)."""
+    logger = logging.getLogger('runner_logger')
+
+    adapter = HTTPAdapter(pool_connections=threads, pool_maxsize=threads)
+    http = requests.Session()
+    http.mount("http://", adapter)
+    http.mount("https://", adapter)
+
+    def upload_file(path):
+        file_name = os.path.basename(path) + (".gz" if compress else "")
+        url = get_upload_url(storage, build_name, build_number, file_name)
+        try:
+            return upload(http, path, url, compress)
+        except UploadError as e:
+            logger.error(str(e))
+        except (IOError, OSError) as e:
+            # e.g. the file was removed or it isn't readable
+            logger.error("Failed to upload {0}: {1}".format(path, e))
+        return None, 0
+
+    started = time.time()
+    pool = ThreadPool(threads)
+    try:
+        results = pool.map(upload_file, paths)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - started
+
+    urls = [url for url, _ in results]
+    uploaded_size = sum(size for url, size in results if url)
+    print("Uploaded {0} of {1} files ({2:.1f} MB) in {3:.1f}s: {4:.2f} MB/s".format(
+        len(filter(None, urls)), len(paths), uploaded_size / 2.0 ** 20, elapsed,
+        uploaded_size / 2.0 ** 20 / elapsed if elapsed else 0))
+
+    return dict(zip(paths, urls))
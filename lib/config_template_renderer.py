@@ -4,18 +4,46 @@ This module processes rendering for test configuration files with Jinja2 templat
 It allows to use clients and servers variables in these test configs as well as
 any variable from **params** test config's section.
 
+Compiled templates are shared by all renderings (and their bytecode is kept on disk
+between runs); clients and servers lists are built once per inventory.
+
 """
 
 import json
-import copy
-import os
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
 import ansible_manager
 
 from test_helper.utils import Node, Client
 
+# Number of compiled templates kept in memory
+TEMPLATES_CACHE_SIZE = 400
+
+_environment = None
+_hosts_cache = {}
+
+def _get_environment():
+    """Returns Jinja2 environment shared by all renderings."""
+    global _environment
+    if _environment is None:
+        # the default cache directory is checked to be private (it keeps executable bytecode)
+        _environment = Environment(loader=FileSystemLoader('/'),
+                                   cache_size=TEMPLATES_CACHE_SIZE,
+                                   bytecode_cache=FileSystemBytecodeCache())
+    return _environment
+
+def _memoized(func):
+    """Caches hosts lists by function's arguments (lists are used as tuples)."""
+    def wrapper(*args):
+        key = (func.__name__,) + tuple(tuple(arg) if isinstance(arg, list) else arg
+                                       for arg in args)
+        if key not in _hosts_cache:
+            _hosts_cache[key] = func(*args)
+        return _hosts_cache[key]
+    return wrapper
+
+@_memoized
 def _get_clients(clients_count, clients_names):
     client_port = 1083
     clients = [Client(client_name, client_port)
@@ -23,6 +51,7 @@ def _get_clients(clients_count, clients_names):
 
     return clients
 
+@_memoized
 def _get_servers(servers_per_group, servers_names):
     servers = []
     server_port = 1025
@@ -35,14 +64,18 @@ def _get_servers(servers_per_group, servers_names):
 
     return servers
 
+def compile_template(path):
+    """Compiles test config template (raises TemplateError if it's broken)."""
+    _get_environment().get_template(path)
+
 def get_running(path, params, instances_names, clients_count, servers_per_group):
     """Returns test config as dictionary."""
-    variables = copy.deepcopy(params)
+    # parameters are only read while rendering, so they aren't copied
+    variables = dict(params)
     variables["clients"] = _get_clients(clients_count, instances_names["clients"])
     variables["servers"] = _get_servers(servers_per_group, instances_names["servers"])
     # Render test config
-    environment = Environment(loader=FileSystemLoader('/'))
-    template = environment.get_template(path)
+    template = _get_environment().get_template(path)
     out = template.render(**variables)
 
     cfg = json.loads(out)
@@ -0,0 +1,115 @@
+"""Tests' configs index module.
+
+This module keeps a persistent index of tests' configs
+(**path**: mtime, size, tags and order of the test) and of configs' directories,
+so only changed configs and directories are read again.
+
+"""
+
+import os
+import json
+import fnmatch
+import hashlib
+import tempfile
+
+# Per-user directory: the index can't be replaced by other users
+INDEX_DIR = os.path.expanduser("~/.cache/tests-runner")
+# Index format version (an index of another version is built again)
+INDEX_VERSION = 2
+
+def get_index_path(configs_dir):
+    """Returns path of the index for configs' directory."""
+    name = hashlib.sha1(os.path.abspath(configs_dir)).hexdigest()
+    return os.path.join(INDEX_DIR, "tests-runner-index-{0}.json".format(name))
+
+def _load(index_path):
+    if os.path.exists(index_path):
+        try:
+            with open(index_path) as index_file:
+                index = json.load(index_file)
+            if index.get("version") == INDEX_VERSION:
+                return index
+        except ValueError:
+            pass
+    return {"version": INDEX_VERSION, "dirs": {}, "configs": {}}
+
+def _save(index_path, index):
+    index_dir = os.path.dirname(os.path.abspath(index_path))
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir, 0700)
+    # the index can be saved by concurrent processes (e.g. shards), so it's replaced atomically
+    fd, path = tempfile.mkstemp(dir=index_dir)
+    with os.fdopen(fd, 'w') as index_file:
+        json.dump(index, index_file)
+    os.rename(path, index_path)
+
+def _list_dir(path, index):
+    """Returns subdirectories and tests' configs of the directory."""
+    mtime = os.stat(path).st_mtime
+    cached = index["dirs"].get(path)
+    if cached is not None and cached["mtime"] == mtime:
+        return cached["subdirs"], cached["configs"]
+
+    subdirs, configs = [], []
+    for name in os.listdir(path):
+        subdir = os.path.join(path, name)
+        # symlinked directories aren't followed (like os.walk does), they can make a cycle
+        if os.path.isdir(subdir) and not os.path.islink(subdir):
+            subdirs.append(name)
+        elif fnmatch.fnmatch(name, 'test_*.cfg'):
+            configs.append(name)
+    index["dirs"][path] = {"mtime": mtime, "subdirs": subdirs, "configs": configs}
+    return subdirs, configs
+
+def _get_entry(path, index):
+    """Returns index entry of the config (the config is read only if it was changed)."""
+    stat = os.stat(path)
+    entry = index["configs"].get(path)
+    if entry is None or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+        with open(path) as cfg_file:
+            cfg = json.load(cfg_file)
+        entry = {"mtime": stat.st_mtime,
+                 "size": stat.st_size,
+                 "tags": cfg["tags"],
+                 "order": cfg.get("order")}
+        index["configs"][path] = entry
+    return entry
+
+def update(configs_dir, index_path=None):
+    """Updates the index of configs' directory and returns
+    dictionary: **config path**: **index entry**.
+    """
+    index_path = index_path or get_index_path(configs_dir)
+    index = _load(index_path)
+
+    entries = {}
+    visited = set()
+    dirs = [os.path.abspath(configs_dir)]
+    while dirs:
+        path = dirs.pop()
+        visited.add(path)
+        subdirs, configs = _list_dir(path, index)
+        dirs.extend(os.path.join(path, name) for name in subdirs)
+        for name in configs:
+            cfg_path = os.path.join(path, name)
+            entries[cfg_path] = _get_entry(cfg_path, index)
+
+    # forget removed configs and directories
+    index["configs"] = {path: index["configs"][path] for path in entries}
+    index["dirs"] = {path: index["dirs"][path] for path in visited}
+
+    _save(index_path, index)
+    return entries
+
+def find_tests(configs_dir, tags, index_path=None):
+    """Returns dictionary: **test name**: **index entry with config path**
+    for tests with given tags (all tests if tags are None).
+    """
+    tags = set(tags) if tags is not None else None
+    tests = {}
+    for path, entry in update(configs_dir, index_path).items():
+        if tags is None or tags.intersection(entry["tags"]):
+            # test config name format: "test_NAME.cfg"
+            test_name = os.path.splitext(os.path.basename(path))[0][5:]
+            tests[test_name] = dict(entry, path=path)
+    return tests
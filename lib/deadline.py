@@ -0,0 +1,105 @@
+"""Deadlines module.
+
+This module provides time budgets which work from any thread (unlike SIGALRM).
+A budget can be split into nested stages: a stage never outlives its parent,
+and the time spent in every stage is recorded for reporting.
+
+    >>> with Deadline(600, "provisioning") as provisioning:
+    ...     with provisioning.stage("instances", 300) as stage:
+    ...         while not ready():
+    ...             stage.sleep(1)
+    ...
+    >>> print(provisioning.report())
+
+"""
+
+import time
+import threading
+
+class TimeoutError(Exception):
+    pass
+
+class Deadline(object):
+    """Time budget (timeout=None means unlimited budget)."""
+    def __init__(self, timeout=None, name=None, parent=None):
+        self.name = name
+        self.parent = parent
+        self.started = time.time()
+        self.expires = None if timeout is None else self.started + timeout
+        self.finished = None
+        self.stages = []
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+        if parent is not None:
+            with parent._lock:
+                parent.stages.append(self)
+            if parent.cancelled:
+                self._cancelled.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.finished = time.time()
+
+    def stage(self, name, timeout=None):
+        """Returns a nested deadline for a stage."""
+        return Deadline(timeout, name, parent=self)
+
+    def _chain(self):
+        deadline = self
+        while deadline is not None:
+            yield deadline
+            deadline = deadline.parent
+
+    def remaining(self):
+        """Returns seconds left (None for unlimited budget)."""
+        now = time.time()
+        remains = [deadline.expires - now for deadline in self._chain()
+                   if deadline.expires is not None]
+        if not remains:
+            return None
+        return max(0, min(remains))
+
+    def elapsed(self):
+        """Returns seconds spent in the stage."""
+        return (self.finished or time.time()) - self.started
+
+    def cancel(self):
+        """Cancels the deadline and all its stages (waiting threads are woken up)."""
+        self._cancelled.set()
+        with self._lock:
+            stages = list(self.stages)
+        for stage in stages:
+            stage.cancel()
+
+    @property
+    def cancelled(self):
+        return any(deadline._cancelled.is_set() for deadline in self._chain())
+
+    def expired(self):
+        return self.cancelled or self.remaining() == 0
+
+    def check(self):
+        """Raises TimeoutError if the deadline is expired or cancelled."""
+        if self.expired():
+            reason = "cancelled" if self.cancelled else "timed out"
+            raise TimeoutError("{0} {1} after {2:.1f}s".format(self.name, reason, self.elapsed()))
+
+    def sleep(self, seconds):
+        """Sleeps (at most till the deadline) and then checks the deadline."""
+        remaining = self.remaining()
+        if remaining is not None:
+            seconds = min(seconds, remaining)
+        self._cancelled.wait(seconds)
+        self.check()
+
+    def report(self, indent=0):
+        """Returns elapsed time of the deadline and all its stages as text."""
+        lines = ["{0}{1}: {2:.1f}s".format("\t" * indent, self.name, self.elapsed())]
+        with self._lock:
+            stages = list(self.stages)
+        for stage in stages:
+            lines.append(stage.report(indent + 1))
+        return "\n".join(lines)
@@ -0,0 +1,89 @@
+"""Tests' durations history module.
+
+This module keeps durations of tests' stages (setup, run and teardown of every test's run)
+in a local SQLite database. Recent durations are used to estimate how long tests take
+(to order and split them) and to find tests which timed out.
+
+"""
+
+import os
+import time
+import sqlite3
+import contextlib
+
+from collections import defaultdict
+
+# Number of recent durations of a stage which are taken into account
+HISTORY_SIZE = 5
+# Seconds to wait for the database locked by another process
+LOCK_TIMEOUT = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS durations (
+    test TEXT NOT NULL,
+    run TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    duration REAL NOT NULL,
+    timed_out INTEGER NOT NULL DEFAULT 0,
+    finished REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS durations_test ON durations (test, run, stage, finished);
+"""
+
+@contextlib.contextmanager
+def _connect(db_path):
+    # a connection per call: the database is shared by forked child processes
+    db_dir = os.path.dirname(os.path.abspath(db_path))
+    if not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    connection = sqlite3.connect(db_path, timeout=LOCK_TIMEOUT)
+    try:
+        connection.executescript(_SCHEMA)
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+def record(db_path, test_name, run_name, stage, duration, timed_out=False):
+    """Stores duration of the test's run stage
+    (only HISTORY_SIZE recent durations of the stage are kept).
+    """
+    key = (test_name, run_name, stage)
+    with _connect(db_path) as connection:
+        connection.execute("INSERT INTO durations VALUES (?, ?, ?, ?, ?, ?)",
+                           key + (duration, int(timed_out), time.time()))
+        connection.execute("DELETE FROM durations WHERE test = ? AND run = ? AND stage = ? "
+                           "AND rowid NOT IN (SELECT rowid FROM durations "
+                           "WHERE test = ? AND run = ? AND stage = ? "
+                           "ORDER BY finished DESC LIMIT ?)",
+                           key + key + (HISTORY_SIZE,))
+
+def _get_recent(db_path):
+    """Returns dictionary: (**test**, **run**, **stage**): **list of recent (duration, timed_out)**
+    (the most recent first).
+    """
+    recent = defaultdict(list)
+    with _connect(db_path) as connection:
+        rows = connection.execute("SELECT test, run, stage, duration, timed_out FROM durations "
+                                  "ORDER BY finished DESC")
+        for test_name, run_name, stage, duration, timed_out in rows:
+            history = recent[(test_name, run_name, stage)]
+            if len(history) < HISTORY_SIZE:
+                history.append((duration, bool(timed_out)))
+    return recent
+
+def get_estimates(db_path):
+    """Returns dictionary: **test name**: (**estimated duration**, **number of known runs**).
+    Test's duration is a sum of average recent durations of its runs' stages.
+    """
+    estimates = defaultdict(float)
+    runs = defaultdict(set)
+    for (test_name, run_name, stage), history in _get_recent(db_path).items():
+        estimates[test_name] += sum(duration for duration, _ in history) / len(history)
+        runs[test_name].add(run_name)
+    return {test_name: (estimates[test_name], len(runs[test_name])) for test_name in estimates}
+
+def get_timed_out(db_path):
+    """Returns names of tests which runs timed out last time."""
+    return set(test_name for (test_name, _, _), history in _get_recent(db_path).items()
+               if history[0][1])
@@ -1,63 +1,155 @@
 import openstack
+import profiler
 import copy
 import itertools
+import hashlib
+import json
 
-_flavors = None
+from multiprocessing.pool import ThreadPool
+
+# Maximal number of concurrent OpenStack API requests while provisioning
+CONCURRENCY = 8
+# Statuses of instances which can be rebuilt (instances in transitional statuses,
+# e.g. BUILD or REBUILD left by an aborted run, are rejected by Nova)
+REBUILDABLE_STATUSES = ("ACTIVE", "SHUTOFF")
+
+_session = None
+
+def _get_session():
+    """Returns OpenStack session shared by the module."""
+    global _session
+    if _session is None:
+        _session = openstack.Session()
+    return _session
 
 def _get_flavors():
     """Returns dictionary: **flavor_name**: **flavor_ram**."""
-    global _flavors
-    if _flavors is None:
-        _flavors = {None: 0}
-        session = openstack.Session()
-        for flavor in session.get_flavors_list():
-            _flavors[flavor['name']] = flavor['ram']
-    return _flavors
+    flavors = {None: 0}
+    for flavor in _get_session().catalog.items("flavors"):
+        flavors[flavor['name']] = flavor['ram']
+    return flavors
 
 def _get_flavor_name(flavor_id, session):
     """Returns flavor name by id."""
-    flavor_list = session.get_flavors_list()
-    for flavor in flavor_list:
-        if flavor['id'] == flavor_id:
-            return flavor['name']
-    else:
-        return None
-
-def _satisfied(instance_name, flavor_name, session):
-    #TODO: temporary fix for rebuild bug
-    # rebuild isn't working; we are forcing to recreate instances instead of rebuilding them
-    return False
+    flavor = session.catalog.by_id("flavors", flavor_id)
+    return flavor['name'] if flavor else None
+
+def _satisfied(instance_info, flavor_name, session):
+    """Checks that instance's flavor has enough RAM."""
+    current_flavor_name = _get_flavor_name(instance_info['flavor']['id'], session)
+    flavors = _get_flavors()
+    return flavors.get(current_flavor_name, 0) >= flavors[flavor_name]
+
+def _get_fingerprint(instance_cfg):
+    """Returns fingerprint of instance's setup (image, flavor, networks and cloud-init config)."""
+    setup = {"image_name": instance_cfg["image_name"],
+             "flavor_name": instance_cfg["flavor_name"],
+             "networks_label_list": sorted(instance_cfg["networks_label_list"]),
+             "user_data": openstack.utils.USER_DATA}
+    return hashlib.sha1(json.dumps(setup, sort_keys=True)).hexdigest()
+
+def _get_metadata(instance_cfg):
+    """Returns metadata which is recorded in the instance to reuse it later."""
+    return {"image_name": instance_cfg["image_name"],
+            "flavor_name": instance_cfg["flavor_name"],
+            "fingerprint": _get_fingerprint(instance_cfg)}
+
+def _get_warm_pool_action(instance_name, instance_cfg, session):
+    """Returns what to do with existing instance: "reuse", "rebuild" or "create"."""
     instance_info = session.get_instance_info(instance_name)
-    if instance_info is None:
-        return False
-    else:
-        current_flavor_name = _get_flavor_name(instance_info['flavor']['id'], session)
-        flavors = _get_flavors()
-        return flavors[current_flavor_name] >= flavors[flavor_name]
-
-def create(instances_cfg):
-    session = openstack.Session()
+    if instance_info is None or instance_info['status'] not in REBUILDABLE_STATUSES:
+        return "create"
+
+    metadata = instance_info.get('metadata', {})
+    if metadata.get('image_name') != instance_cfg["image_name"] or \
+       not _satisfied(instance_info, instance_cfg["flavor_name"], session):
+        return "create"
+
+    if metadata.get('fingerprint') == _get_fingerprint(instance_cfg) and \
+       instance_info['status'] == "ACTIVE":
+        return "reuse"
+    return "rebuild"
+
+def _get_creation_cfgs(instance_cfg, instances_names):
+    """Returns configs to create given instances of the config
+    (all instances are created with a single request if it's possible).
+    """
+    if instances_names == openstack.utils.get_instances_names_from_conf(instance_cfg):
+        return [instance_cfg]
+
+    cfgs = []
+    for instance_name in instances_names:
+        icfg = copy.deepcopy(instance_cfg)
+        icfg["name"] = instance_name
+        icfg["max_count"] = icfg["min_count"] = 1
+        cfgs.append(icfg)
+    return cfgs
+
+def create(instances_cfg, concurrency=CONCURRENCY, warm_pool=False):
+    """Recreates instances and returns their names
+    (requests are sent concurrently, at most **concurrency** at once).
+
+    In warm pool mode existing instances with the same image and enough RAM are
+    reused as is (if their setup fingerprint is the same) or rebuilt;
+    other instances are recreated.
+    """
+    session = _get_session()
+    if warm_pool:
+        # take a snapshot of existing instances to check them all at once
+        session.get_instances_details()
 
+    instances_cfg = {instance_type: dict(instance_cfg, metadata=_get_metadata(instance_cfg))
+                     for instance_type, instance_cfg in instances_cfg.items()}
     instances_names = {}
+    to_rebuild = []
+    to_create = {}
     for instance_type, instance_cfg in instances_cfg.items():
         instances_names[instance_type] = openstack.utils.get_instances_names_from_conf(instance_cfg)
         for instance_name in instances_names[instance_type]:
-            if _satisfied(instance_name, instance_cfg["flavor_name"], session):
-                session.rebuild_instance(instance_name)
+            if warm_pool:
+                action = _get_warm_pool_action(instance_name, instance_cfg, session)
             else:
-                icfg = copy.deepcopy(instance_cfg)
-                icfg["name"] = instance_name
-                icfg["max_count"] = icfg["min_count"] = 1
-                icfg = {"servers": [icfg]}
-
-                session.delete_instance(instance_name)
-                openstack.utils.wait_till_deleted(session, instance_name)
-                session.create_instances(icfg, check=False)
+                action = "create"
+
+            if action == "rebuild":
+                to_rebuild.append((instance_name, instance_cfg["metadata"]))
+            elif action == "create":
+                to_create.setdefault(instance_type, []).append(instance_name)
+
+    to_delete = list(itertools.chain.from_iterable(to_create.values()))
+    creation_cfgs = []
+    for instance_type, names in to_create.items():
+        creation_cfgs += _get_creation_cfgs(instances_cfg[instance_type], names)
+
+    pool = ThreadPool(concurrency)
+    try:
+        with profiler.span("rebuild_instances", hosts=len(to_rebuild)):
+            pool.map(lambda args: session.rebuild_instance(*args), to_rebuild)
+
+        with profiler.span("delete_instances", key="provisioning.delete", hosts=len(to_delete)):
+            pool.map(session.delete_instance, to_delete)
+            openstack.utils.wait_till_deleted(session, to_delete)
+            # Waiting for DNS records update
+            openstack.utils.wait_till_unresolved(to_delete)
+
+        with profiler.span("create_instances", hosts=len(to_delete)):
+            pool.map(lambda cfg: session.create_instance(data=cfg), creation_cfgs)
+    finally:
+        pool.close()
+        pool.join()
 
     instances_names_list = list(itertools.chain.from_iterable(instances_names.values()))
-    if openstack.utils.check_availability(session, instances_names_list):
-        # Extending hostnames to FQDN
+    available = openstack.utils.check_availability(session, instances_names_list)
+
+    stats = session.get_connections_stats()
+    print("OpenStack API connections: {opened} opened, {reused} reused".format(**stats))
+
+    if available:
         for instance_type, instance_names in instances_names.items():
+            # Spare instances are kept booted for next runs only
+            spare_count = instances_cfg[instance_type].get("spare_count", 0)
+            instance_names = instance_names[:len(instance_names) - spare_count]
+            # Extending hostnames to FQDN
             instances_names[instance_type] = [openstack.utils.get_fqdn(name, session.hostname_prefix)
                                               for name in instance_names]
         return instances_names
@@ -73,17 +165,19 @@ def _flavors_order(flavor):
     """
     return _get_flavors()[flavor]
 
-def get_instances_cfg(instances_params, base_names):
+def get_instances_cfg(instances_params, base_names, spare_count=0):
     """ Prepares instances config for future usage
+    (with **spare_count** additional instances of each type)
     """
     clients_conf = _get_cfg(base_names['client'],
                             instances_params["clients"]["flavor"],
-                            instances_params["clients"]["count"],
+                            instances_params["clients"]["count"] + spare_count,
                             instances_params["clients"]["image"])
     servers_conf = _get_cfg(base_names['server'],
                             instances_params["servers"]["flavor"],
-                            instances_params["servers"]["count"],
+                            instances_params["servers"]["count"] + spare_count,
                             instances_params["servers"]["image"])
+    clients_conf["spare_count"] = servers_conf["spare_count"] = spare_count
     if servers_conf["max_count"] == 1:
         servers_conf["name"] += "-1"
     if clients_conf["max_count"] == 1:
@@ -3,32 +3,72 @@ import requests
 import base64
 import json
 import time
-import socket
 import os
+import re
+import urllib
 
 import utils
+import profiler
+
+from auth import TokenManager
+from catalog import Catalog
 
 class Session:
     def __init__(self, auth_url=None, login=None, password=None,
-                 tenant_name=None, region_name=None, hostname_prefix=None):
+                 tenant_name=None, region_name=None, hostname_prefix=None, pool_size=None,
+                 catalog_cache=None):
         auth_url = auth_url or os.environ.get('OS_AUTH_URL')
         login = login or os.environ.get('OS_USERNAME')
         self.password = password or os.environ.get('OS_PASSWORD')
-        region_name = region_name or os.environ.get('OS_REGION_NAME')
+        self.region_name = region_name or os.environ.get('OS_REGION_NAME')
         tenant_name = tenant_name or os.environ.get('OS_TENANT_NAME')
         self.hostname_prefix = hostname_prefix or os.environ.get('OS_HOSTNAME_PREFIX')
-        user_info = utils.get_user_info(auth_url, login, self.password, tenant_name)
-        # Collect authorization token
-        self.token_id = user_info['access']['token']['id']
-        # Collect services' endpoints
-        self.service_catalog = utils.get_service_catalog(user_info['access']['serviceCatalog'],
-                                                         region_name)
+        # Keep-alive connections are shared by all requests of the session
+        self.http = utils.get_http_session(pool_size or utils.POOL_SIZE)
+        # Token is shared by all sessions of the user
+        self.token_manager = TokenManager.get(auth_url, login, self.password, tenant_name)
+        self.token_id = None
+        self._authenticate()
+        # Snapshot of instances' details (name -> details) and the time it was taken
+        self._instances = None
+        self._instances_time = 0
+        # Index of instances' ids by names
+        self._instances_ids = {}
+        # Images, flavors and networks
+        self.catalog = Catalog(self, cache_path=catalog_cache or os.environ.get('OS_CATALOG_CACHE'))
+
+    def _authenticate(self, stale_token=None):
+        """Takes valid token and services' endpoints from the token manager."""
+        user_info = self.token_manager.get_user_info(self.http, stale_token)
+        token_id = user_info['access']['token']['id']
+        if token_id != self.token_id:
+            # Collect authorization token
+            self.token_id = token_id
+            # Collect services' endpoints
+            self.service_catalog = utils.get_service_catalog(user_info['access']['serviceCatalog'],
+                                                             self.region_name)
+
+    def _send(self, method, url, headers, **kwargs):
+        """Sends request with authorization token
+        (the token is refreshed if it expires soon or if it's rejected).
+        """
+        self._authenticate()
+        headers['X-Auth-Token'] = self.token_id
+        profiler.count("openstack_api_calls")
+        r = method(url, headers=headers, timeout=utils.TIMEOUT, **kwargs)
+
+        if r.status_code == requests.status_codes.codes.unauthorized:
+            self._authenticate(stale_token=headers['X-Auth-Token'])
+            headers['X-Auth-Token'] = self.token_id
+            profiler.count("openstack_api_calls")
+            r = method(url, headers=headers, timeout=utils.TIMEOUT, **kwargs)
+
+        return r
 
     def get(self, url):
-        headers = {'Accept': "application/json",
-                   'X-Auth-Token': self.token_id}
+        headers = {'Accept': "application/json"}
 
-        r = requests.get(url, headers=headers, timeout=utils.TIMEOUT)
+        r = self._send(self.http.get, url, headers)
 
         if r.status_code != requests.status_codes.codes.ok:
             raise utils.OpenStackApiError(r.json(), r.status_code)
@@ -38,11 +78,10 @@ class Session:
     def post(self, url, data):
         headers = {
             'Content-Type': "application/json",
-            'Accept': "application/json",
-            'X-Auth-Token': self.token_id
+            'Accept': "application/json"
         }
 
-        r = requests.post(url, data=json.dumps(data), headers=headers, timeout=utils.TIMEOUT)
+        r = self._send(self.http.post, url, headers, data=json.dumps(data))
 
         if r.status_code not in [requests.status_codes.codes.ok,
                                  requests.status_codes.codes.accepted]:
@@ -52,27 +91,25 @@ class Session:
 
     def delete(self, url):
         headers = {'Content-Type': "application/json",
-                   'Accept': "application/json",
-                   'X-Auth-Token': self.token_id}
+                   'Accept': "application/json"}
 
-        r = requests.delete(url, headers=headers, timeout=utils.TIMEOUT)
+        r = self._send(self.http.delete, url, headers)
 
         if r.status_code != 204:
             raise utils.OpenStackApiError(r.json(), r.status_code)
 
+    def get_connections_stats(self):
+        """Returns numbers of opened and reused HTTP connections."""
+        return utils.get_connections_stats(self.http)
+
     def create_instances(self, config, check=True):
         # Waiting for DNS records update
         instances = []
         for instance_cfg in config['servers']:
             instances += utils.get_instances_names_from_conf(instance_cfg)
 
-        for i in instances:
-            try:
-                while socket.gethostbyname(i):
-                    print '.',
-                    time.sleep(3)
-            except socket.gaierror:
-                print('\nA-record for {0} was deleted'.format(i))
+        utils.wait_till_unresolved(instances)
+        print('A-records for {0} were deleted'.format(", ".join(instances)))
 
         for instance_cfg in config['servers']:
             self.create_instance(data=instance_cfg)
@@ -112,6 +149,7 @@ class Session:
         url = utils.get_url(self.service_catalog['compute'], "SERVERS")
 
         instance_info = self.post(url, data)
+        self._invalidate_instances(data['server']['name'])
 
         return instance_info
 
@@ -128,10 +166,11 @@ class Session:
                             instance_id=instance_id)
 
         self.delete(url)
+        self._invalidate_instances(instance_name)
 
         return True
 
-    def rebuild_instance(self, instance_name):
+    def rebuild_instance(self, instance_name, metadata=None):
         """ Fast recreating instance with the same name and image
         """
         instance_info = self.get_instance_info(instance_name)
@@ -144,11 +183,14 @@ class Session:
         data = {"rebuild": {"name": instance_name,
                             "imageRef": image_ref,
                             "adminPass": self.password}}
+        if metadata is not None:
+            data['rebuild']['metadata'] = metadata
 
         url = utils.get_url(self.service_catalog['compute'], "ACTION",
                             server_id=instance_id)
 
         response = self.post(url, data)
+        self._invalidate_instances()
 
         return response
 
@@ -174,23 +216,16 @@ class Session:
         return networks_list
 
     def get_image_id(self, image_name):
-        images_list = self.get_images_list()
-        for image in images_list:
-            if image['name'] == image_name:
-                return image['id']
-        return None
+        image = self.catalog.by_name("images", image_name)
+        return image['id'] if image else None
 
     def get_flavor_id(self, flavor_name):
-        flavors_list = self.get_flavors_list()
-        for flavor in flavors_list:
-            if flavor['name'] == flavor_name:
-                return flavor['id']
-        return None
+        flavor = self.catalog.by_name("flavors", flavor_name)
+        return flavor['id'] if flavor else None
 
     def get_networks_uuid_list(self, networks_label_list):
-        networks_list = self.get_networks_list()
         uuid_list = []
-        for network in networks_list:
+        for network in self.catalog.items("networks"):
             if network['label'] in networks_label_list:
                 uuid_list.append({"uuid": str(network['id'])})
         return uuid_list
@@ -211,31 +246,70 @@ class Session:
         if config.get('key_name') is not None:
             data['server']['key_name'] = config['key_name']
 
+        if config.get('metadata') is not None:
+            data['server']['metadata'] = config['metadata']
+
         return data
 
     def get_instance_info(self, instance_name):
-        # get instance's id
-        created_instances = self.get_instances()
-        for i in created_instances:
-            if i['name'] == instance_name:
-                instance_id = str(i['id'])
-                break
-        else:
+        """ Returns instance's details or None if there is no such instance
+        (uses a fresh snapshot of instances, the index of ids or name filtering)
+        """
+        if self._instances is not None and \
+           time.time() - self._instances_time <= utils.INSTANCES_CACHE_TTL:
+            return self._instances.get(instance_name)
+
+        instance_id = self._instances_ids.get(instance_name)
+        if instance_id is None:
+            for instance in self.get_instances(name=instance_name, detail=True):
+                if instance['name'] == instance_name:
+                    self._instances_ids[instance_name] = instance['id']
+                    return instance
             return None
-                
+
         url = utils.get_url(self.service_catalog['compute'], "SERVERS_SERVER",
                             instance_id=instance_id)
         try:
             instance = self.get(url)['server']
         except utils.OpenStackApiError as e:
             if e.response_code == requests.status_codes.codes.not_found:
-                return None
+                # the instance could be recreated with a new id; look it up by name
+                self._instances_ids.pop(instance_name, None)
+                return self.get_instance_info(instance_name)
             else:
                 raise
-        
+
+        if instance['name'] != instance_name:
+            # the instance was renamed; look it up by name
+            self._instances_ids.pop(instance_name, None)
+            return self.get_instance_info(instance_name)
+
         return instance
 
-    def get_instances(self):
-        url = utils.get_url(self.service_catalog['compute'], "SERVERS")
+    def get_instances_details(self, max_age=utils.INSTANCES_CACHE_TTL):
+        """ Returns dictionary: **instance name**: **instance details**
+        (the snapshot is requested again if it's older than max_age seconds)
+        """
+        if self._instances is None or time.time() - self._instances_time > max_age:
+            instances = self.get_instances(detail=True)
+            self._instances = {i['name']: i for i in instances}
+            self._instances_ids = {i['name']: i['id'] for i in instances}
+            self._instances_time = time.time()
+        return self._instances
+
+    def get_instances(self, name=None, detail=False):
+        """ Returns list of instances
+        (only instances with given name if it's specified)
+        """
+        url = utils.get_url(self.service_catalog['compute'],
+                            "SERVERS_DETAIL" if detail else "SERVERS")
+        if name is not None:
+            # Nova filters instances' names with regular expression
+            url += "?" + urllib.urlencode({"name": "^{}$".format(re.escape(name))})
         instances = self.get(url)['servers']
         return instances
+
+    def _invalidate_instances(self, instance_name=None):
+        """Drops the snapshot of instances (and the instance's id from the index)."""
+        self._instances = None
+        self._instances_ids.pop(instance_name, None)
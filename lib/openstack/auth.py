@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import stat
+import time
+import fcntl
+import logging
+import hashlib
+import calendar
+import tempfile
+import threading
+
+import utils
+
+# The token is refreshed when it expires in less than TOKEN_REFRESH_MARGIN seconds
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_CACHE_DIR = os.environ.get('OS_TOKEN_CACHE_DIR',
+                                 os.path.expanduser("~/.cache/openstack-tokens"))
+
+def _is_private(path):
+    """Checks that the path isn't a symlink, it's owned by the user
+    and isn't accessible by other users.
+    """
+    path_stat = os.lstat(path)
+    return not stat.S_ISLNK(path_stat.st_mode) and \
+        path_stat.st_uid == os.getuid() and \
+        not path_stat.st_mode & (stat.S_IRWXG | stat.S_IRWXO)
+
+class TokenManager(object):
+    """Keeps authorization token and service catalog of a user.
+
+    Token managers are shared by sessions of the same user (see TokenManager.get);
+    the token is kept in a file to share it with other processes.
+    """
+    _managers = {}
+    _managers_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, auth_url, login, password, tenant_name, cache_dir=TOKEN_CACHE_DIR):
+        """Returns token manager shared by all sessions of the user."""
+        key = (auth_url, login, tenant_name)
+        with cls._managers_lock:
+            if key not in cls._managers:
+                cls._managers[key] = cls(auth_url, login, password, tenant_name, cache_dir)
+            return cls._managers[key]
+
+    def __init__(self, auth_url, login, password, tenant_name, cache_dir=TOKEN_CACHE_DIR):
+        self.auth_url = auth_url
+        self.login = login
+        self.password = password
+        self.tenant_name = tenant_name
+        self._user_info = None
+        self._lock = threading.Lock()
+
+        self.cache_path = None
+        if cache_dir:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir, 0700)
+            # the cache keeps credentials, so it's used only if nobody else can change it
+            if not _is_private(cache_dir):
+                logging.getLogger('runner_logger').error(
+                    "Token cache directory {0} isn't private, the cache isn't used".format(cache_dir))
+                return
+            key = json.dumps([auth_url, login, tenant_name])
+            self.cache_path = os.path.join(cache_dir, hashlib.sha1(key).hexdigest() + ".json")
+
+    @staticmethod
+    def _get_token(user_info):
+        return user_info['access']['token']
+
+    def _valid(self, user_info):
+        """Checks that the token won't expire soon."""
+        if user_info is None:
+            return False
+        # expiration time format: 2015-03-13T15:32:40Z
+        expires = self._get_token(user_info)['expires'][:19]
+        expires = calendar.timegm(time.strptime(expires, "%Y-%m-%dT%H:%M:%S"))
+        return expires - time.time() > TOKEN_REFRESH_MARGIN
+
+    def _read_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return None
+        if not _is_private(self.cache_path):
+            return None
+        try:
+            with open(self.cache_path) as cache_file:
+                return json.load(cache_file)
+        except ValueError:
+            # corrupted cache
+            return None
+
+    def _write_cache(self, user_info):
+        if not self.cache_path:
+            return
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(self.cache_path))
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(user_info, cache_file)
+        os.rename(path, self.cache_path)
+
+    def get_user_info(self, http=None, stale_token=None):
+        """Returns information about user with valid token.
+        The user is authenticated again if the token expires soon
+        or if it's the stale token (e.g. rejected with 401 response).
+        """
+        with self._lock:
+            if self._usable(self._user_info, stale_token):
+                return self._user_info
+
+            lock_file = None
+            if self.cache_path:
+                # authenticate once for all processes
+                lock_file = open(self.cache_path + ".lock", 'w')
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                user_info = self._read_cache()
+                if not self._usable(user_info, stale_token):
+                    user_info = utils.get_user_info(self.auth_url, self.login, self.password,
+                                                    self.tenant_name, http)
+                    self._write_cache(user_info)
+            finally:
+                if lock_file is not None:
+                    lock_file.close()
+
+            self._user_info = user_info
+            return user_info
+
+    def _usable(self, user_info, stale_token):
+        return self._valid(user_info) and self._get_token(user_info)['id'] != stale_token
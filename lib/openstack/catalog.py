@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+import tempfile
+import threading
+
+# How long (in seconds) the catalog can be used before requesting it again
+CATALOG_TTL = 600
+
+class Catalog(object):
+    """Images, flavors and networks of the cloud indexed by names and ids.
+
+    The catalog is requested once per TTL; if cache_path is specified
+    it's also kept in the file between runs (the file is used only
+    for the same compute endpoint).
+    """
+    # catalog kind: attribute used as a name
+    KINDS = {"images": 'name',
+             "flavors": 'name',
+             "networks": 'label'}
+
+    def __init__(self, session, ttl=CATALOG_TTL, cache_path=None):
+        self.session = session
+        self.ttl = ttl
+        self.cache_path = cache_path
+        self._catalog = None
+        self._time = 0
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def _expired(self, catalog_time):
+        return time.time() - catalog_time > self.ttl
+
+    def _request(self):
+        return {"images": self.session.get_images_list(),
+                "flavors": self.session.get_flavors_list(),
+                "networks": self.session.get_networks_list()}
+
+    def _get_endpoint(self):
+        return self.session.service_catalog['compute']
+
+    def _read_cache(self):
+        """Returns catalog from the cache file (if it's not expired
+        and it's the catalog of the same endpoint).
+        """
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return None
+        try:
+            with open(self.cache_path) as cache_file:
+                cache = json.load(cache_file)
+            if cache["endpoint"] != self._get_endpoint() or self._expired(cache["time"]):
+                return None
+        except (ValueError, KeyError, TypeError):
+            # corrupted cache
+            return None
+        return cache
+
+    def _write_cache(self):
+        if not self.cache_path:
+            return
+        # the file can be shared by concurrent processes, so it's replaced atomically
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.cache_path)))
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump({"endpoint": self._get_endpoint(),
+                       "time": self._time,
+                       "catalog": self._catalog}, cache_file)
+        os.rename(path, self.cache_path)
+
+    def _get_indexes(self):
+        """Returns indexes of the catalog (requests the catalog if it's needed)."""
+        with self._lock:
+            if self._catalog is None or self._expired(self._time):
+                cache = self._read_cache()
+                if cache is not None:
+                    self._catalog, self._time = cache["catalog"], cache["time"]
+                else:
+                    self._catalog, self._time = self._request(), time.time()
+                    self._write_cache()
+
+                self._indexes = {}
+                for kind, name_attr in self.KINDS.items():
+                    items = self._catalog[kind]
+                    names = {}
+                    for item in items:
+                        # the first item with the name is used (e.g. the newest image)
+                        names.setdefault(item[name_attr], item)
+                    self._indexes[kind] = {"items": items,
+                                           "names": names,
+                                           "ids": {str(item['id']): item for item in items}}
+            return self._indexes
+
+    def items(self, kind):
+        """Returns list of catalog's items of the kind (images, flavors or networks)."""
+        return self._get_indexes()[kind]["items"]
+
+    def by_name(self, kind, name):
+        """Returns catalog's item with the name (or None)."""
+        return self._get_indexes()[kind]["names"].get(name)
+
+    def by_id(self, kind, item_id):
+        """Returns catalog's item with the id (or None)."""
+        return self._get_indexes()[kind]["ids"].get(str(item_id))
+
+    def invalidate(self):
+        with self._lock:
+            self._catalog = None
@@ -1,23 +1,62 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
-import subprocess
-import shlex
-import signal
 import socket
+import select
+import errno
 import requests
 import json
 import time
+import random
+import threading
 
-from collections import deque
 from functools import wraps
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+import profiler
+
+from deadline import Deadline, TimeoutError
 
 TIMEOUT = 60
 
+# HTTP connection pool parameters
+POOL_SIZE = 10
+RETRIES = 3
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = [500, 502, 503, 504]
+
+# How long (in seconds) a snapshot of instances' details can be used
+INSTANCES_CACHE_TTL = 2
+
+# Polling parameters: first interval, maximal interval (in seconds),
+# backoff factor and relative jitter of intervals
+POLL_INTERVAL = 1
+POLL_MAX_INTERVAL = 10
+POLL_BACKOFF_FACTOR = 1.5
+POLL_JITTER = 0.1
+
+# SSH availability check parameters
+SSH_PORT = 22
+SSH_CONNECT_TIMEOUT = 1
+SSH_BANNER_PREFIX = "SSH-"
+
+# DNS resolving parameters: number of resolving threads,
+# how long (in seconds) resolved addresses are shared between callers
+# and how long to wait for DNS records update
+RESOLVE_THREADS = 16
+RESOLVE_CACHE_TTL = 1
+RESOLVE_TIMEOUT = 300
+
+# Overall time budget (in seconds) for instances' availability check
+AVAILABILITY_TIMEOUT = 900
+
 ENDPOINTS_INFO = {"COMPUTE": {'uri': {"IMAGES": 'images',
                                       "FLAVORS": 'flavors/detail',
                                       "NETWORKS": 'os-networks',
                                       "SERVERS": 'servers',
+                                      "SERVERS_DETAIL": 'servers/detail',
                                       "SERVERS_SERVER": 'servers/{instance_id}',
                                       "ACTION": 'servers/{server_id}/action'}},
                   "IDENTITY": {'uri': {"TOKENS": 'tokens'}}}
@@ -38,104 +77,240 @@ class OpenStackApiError(Exception):
     def __str__(self):
         return json.dumps(self.message, indent=4)
 
-class TimeoutError(Exception):
+class InstanceError(Exception):
     pass
 
 def with_timeout(timeout=300):
-    """Raises the timeout exception for decorated function after specific execution time."""
-    def _alarm_handler(signal, frame):
-        raise TimeoutError()
-
+    """Gives decorated function a deadline (passed as ``deadline`` keyword argument).
+    If the caller passes its own deadline, the function gets a stage of it
+    limited with the timeout.
+    """
     def wrapper(func):
         @wraps(func)
         def decorator(*args, **kwargs):
-            # set timeout
-            signal.signal(signal.SIGALRM, _alarm_handler)
-            signal.alarm(timeout)
-
-            try:
-                result = func(*args, **kwargs)
-            finally:
-                # turn off timer when the function processed
-                signal.alarm(0)
-
-            return result
+            parent = kwargs.get('deadline')
+            with Deadline(timeout, func.__name__, parent) as deadline:
+                kwargs['deadline'] = deadline
+                return func(*args, **kwargs)
         return decorator
     return wrapper
 
+def poll_intervals(interval=POLL_INTERVAL, max_interval=POLL_MAX_INTERVAL,
+                   factor=POLL_BACKOFF_FACTOR, jitter=POLL_JITTER):
+    """Generates intervals between polls (with exponential backoff and random jitter)."""
+    while True:
+        yield interval * random.uniform(1 - jitter, 1 + jitter)
+        interval = min(interval * factor, max_interval)
+
 @with_timeout()
-def wait_till_active(session, instances):
+def wait_till_active(session, instances, intervals=None, active_times=None, deadline=None):
     """ Waits till instances will be in ACTIVE status
-    (and returns a list of dicts {instance_name: ip})
+    (and returns a dictionary {instance_fqdn: ip})
+
+    Statuses of all pending instances are requested with a single call per poll.
+    Raises InstanceError if any instance goes to ERROR status.
+    If active_times dictionary is given it's filled with
+    seconds passed till each instance became ACTIVE.
     """
+    intervals = intervals or poll_intervals()
+    started = time.time()
     hosts_ip = {}
-    queue = deque(instances)
-    while queue:
-        instance = queue.pop()
-        instance_info = session.get_instance_info(instance)
-
-        if instance_info['status'] == "ACTIVE":
-            # get ip address
-            network_name = instance_info['addresses'].keys()[0]
-            ip = [address['addr']
-                  for address in instance_info['addresses'][network_name]
-                  if address['version'] == 4]
-            iname = get_fqdn(instance, session.hostname_prefix)
-            hosts_ip[iname] = ip[0]
-            continue
-        queue.appendleft(instance)
-    return hosts_ip
+    pending = set(instances)
+    while True:
+        instances_details = session.get_instances_details(max_age=0)
+        for instance in list(pending):
+            instance_info = instances_details.get(instance)
+            if instance_info is None:
+                # the instance isn't listed yet
+                continue
+
+            if instance_info['status'] == "ERROR":
+                fault = instance_info.get('fault', {}).get('message')
+                raise InstanceError("Instance {} is in ERROR status: {}".format(instance, fault))
+
+            if instance_info['status'] == "ACTIVE":
+                # get ip address
+                network_name = instance_info['addresses'].keys()[0]
+                ip = [address['addr']
+                      for address in instance_info['addresses'][network_name]
+                      if address['version'] == 4]
+                iname = get_fqdn(instance, session.hostname_prefix)
+                hosts_ip[iname] = ip[0]
+                pending.remove(instance)
+                if active_times is not None:
+                    active_times[iname] = time.time() - started
+
+        if not pending:
+            return hosts_ip
+        deadline.sleep(next(intervals))
 
 @with_timeout()
-def check_ssh_port(ip_list):
+def check_ssh_port(ip_list, port=SSH_PORT, interval=POLL_INTERVAL,
+                   connect_timeout=SSH_CONNECT_TIMEOUT, check_banner=False, deadline=None):
     """ Checks that instances' ssh ports are available
+    (all pending hosts are probed at once; returns when every host answered)
     """
-    queue = deque(ip_list)
-    while queue:
-        ip = queue.pop()
-        # availability check
-        cmd = "nc -z -w1 {0} 22".format(ip)
-        if subprocess.call(shlex.split(cmd)) == 0:
-            continue
-        # if it's not available yet then return the instance to the queue
-        queue.appendleft(ip)
+    pending = set(ip_list)
+    while pending:
+        pending -= probe_ports(pending, port, connect_timeout, check_banner)
+        if pending:
+            deadline.sleep(interval)
 
-@with_timeout()
-def check_host_name_resolving(hosts_ip):
+def probe_ports(ip_list, port, timeout, check_banner=False):
+    """ Connects to the port of all hosts at once with non-blocking sockets
+    (and optionally waits for SSH banner); returns a set of hosts which answered
+    """
+    sockets = {}
+    for ip in ip_list:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        if sock.connect_ex((ip, port)) in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sockets[sock] = ip
+        else:
+            sock.close()
+
+    answered = set()
+    connecting = set(sockets)
+    reading = set()
+    deadline = time.time() + timeout
+    try:
+        while connecting or reading:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            readable, writable, _ = select.select(list(reading), list(connecting), [], remaining)
+
+            for sock in writable:
+                connecting.discard(sock)
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    continue
+                if check_banner:
+                    reading.add(sock)
+                else:
+                    answered.add(sockets[sock])
+
+            for sock in readable:
+                reading.discard(sock)
+                try:
+                    banner = sock.recv(len(SSH_BANNER_PREFIX))
+                except socket.error:
+                    continue
+                if banner == SSH_BANNER_PREFIX:
+                    answered.add(sockets[sock])
+    finally:
+        for sock in sockets:
+            sock.close()
+
+    return answered
+
+_resolver_pool = None
+_resolved = {}
+_resolved_lock = threading.Lock()
+
+def _resolve(host):
+    """Returns host's ip or None if the host name isn't resolved."""
+    try:
+        return socket.gethostbyname(host)
+    except socket.error:
+        return None
+
+def resolve_hosts(hosts, max_age=RESOLVE_CACHE_TTL):
+    """ Resolves host names concurrently and returns a dictionary {host: ip or None}
+    (answers not older than max_age seconds are shared between callers)
+    """
+    global _resolver_pool
+
+    result = {}
+    unresolved = []
+    with _resolved_lock:
+        now = time.time()
+        for host in hosts:
+            if host in _resolved and now - _resolved[host][0] <= max_age:
+                result[host] = _resolved[host][1]
+            else:
+                unresolved.append(host)
+
+    if unresolved:
+        if _resolver_pool is None:
+            _resolver_pool = ThreadPool(RESOLVE_THREADS)
+        ips = _resolver_pool.map(_resolve, unresolved)
+        with _resolved_lock:
+            now = time.time()
+            for host, ip in zip(unresolved, ips):
+                _resolved[host] = (now, ip)
+                result[host] = ip
+
+    return result
+
+def wait_for_resolving(hosts_ip, interval=POLL_INTERVAL, deadline=None):
+    """ Waits till host names are resolved to expected ips
+    (None ip means that the host name shouldn't be resolved at all).
+    All pending hosts are checked on every poll; raises TimeoutError with pending hosts.
+    """
+    deadline = deadline or Deadline(RESOLVE_TIMEOUT, "wait_for_resolving")
+    pending = dict(hosts_ip)
+    while True:
+        resolved = resolve_hosts(pending.keys(), max_age=interval)
+        for host, ip in resolved.items():
+            if ip == pending[host]:
+                del pending[host]
+
+        if not pending:
+            return
+        try:
+            deadline.sleep(interval)
+        except TimeoutError as e:
+            raise TimeoutError("{0}; hosts are still pending: {1}".format(e, ", ".join(sorted(pending))))
+
+@with_timeout(RESOLVE_TIMEOUT)
+def check_host_name_resolving(hosts_ip, interval=POLL_INTERVAL, deadline=None):
     """ Checks that ip resolving returns the same ip
     (which one we got from OpenStack API)
     """
-    queue = deque(hosts_ip.items())
-    while queue:
-        host, ip = queue.pop()
-        try:
-            resolved_ip = socket.gethostbyname(host)
-            if resolved_ip == ip:
-                continue
-        except socket.error:
-            pass
-        queue.appendleft((host, ip))
+    wait_for_resolving(hosts_ip, interval, deadline)
+
+@with_timeout(RESOLVE_TIMEOUT)
+def wait_till_unresolved(hosts, interval=POLL_INTERVAL, deadline=None):
+    """Waits till A-records of hosts are deleted."""
+    wait_for_resolving({host: None for host in hosts}, interval, deadline)
 
-def check_availability(session, instances):
+def check_availability(session, instances, deadline=None):
     """ Checks that instances are available
+    (the checks are stages of a single time budget)
     """
-    try:
-        print("Waiting for nodes to initialize...", end=' ')
-        hosts_ip = wait_till_active(session, instances)
-        print("[DONE]")
+    with Deadline(AVAILABILITY_TIMEOUT, "check_availability", deadline) as availability:
+        try:
+            print("Waiting for nodes to initialize...", end=' ')
+            active_times = {}
+            with profiler.span("wait_till_active", key="provisioning.wait_till_active",
+                               hosts=len(instances)):
+                hosts_ip = wait_till_active(session, instances, active_times=active_times,
+                                            deadline=availability)
+            print("[DONE]")
+            for host, seconds in sorted(active_times.items()):
+                print("\t{0} became ACTIVE in {1:.1f}s".format(host, seconds))
 
-        print("Waiting for nodes to become available via SSH...", end=' ')
-        check_ssh_port(hosts_ip.values())
-        print("[DONE]")
+            print("Waiting for nodes to become available via SSH...", end=' ')
+            with profiler.span("check_ssh_port", key="provisioning.check_ssh_port",
+                               hosts=len(hosts_ip)):
+                check_ssh_port(hosts_ip.values(), deadline=availability)
+            print("[DONE]")
 
-        print("Waiting for nodes to start resolving to right IPs...", end=' ')
-        check_host_name_resolving(hosts_ip)
-        print("[DONE]")
+            print("Waiting for nodes to start resolving to right IPs...", end=' ')
+            with profiler.span("check_host_name_resolving",
+                               key="provisioning.check_host_name_resolving", hosts=len(hosts_ip)):
+                check_host_name_resolving(hosts_ip, deadline=availability)
+            print("[DONE]")
 
-        return True
-    except TimeoutError:
-        print("[FAILED] Timeout reached.")
-        return False
+            return True
+        except TimeoutError as e:
+            print("[FAILED] Timeout reached. {0}".format(e))
+            return False
+        except InstanceError as e:
+            print("[FAILED] {0}".format(e))
+            return False
+        finally:
+            print(availability.report())
 
 def get_instances_names_from_conf(instance_cfg):
     """ Returns list of instances' names
@@ -162,8 +337,36 @@ def concat_url(endpoint, url):
     """Concatenates endpoint and url ending."""
     return "{}/{}".format(endpoint.strip("/"), url.strip("/"))
 
-def get_user_info(auth_url, login, password, tenant_name):
+def get_http_session(pool_size=POOL_SIZE, retries=RETRIES, backoff_factor=RETRY_BACKOFF_FACTOR):
+    """Returns HTTP session with keep-alive connection pool.
+    Requests are retried with backoff on connection errors and on 5xx responses
+    (5xx responses are retried only for idempotent methods). When retries are exhausted
+    the last response is returned, so callers can report API's fault.
+    """
+    retry = Retry(total=retries, backoff_factor=backoff_factor,
+                  status_forcelist=RETRY_STATUSES, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    http = requests.Session()
+    http.mount("http://", adapter)
+    http.mount("https://", adapter)
+    return http
+
+def get_connections_stats(http):
+    """Returns numbers of opened connections and of requests which reused them."""
+    stats = {"opened": 0, "reused": 0}
+    # the same adapter can be mounted for several prefixes (http and https)
+    for adapter in set(http.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats["opened"] += pool.num_connections
+            stats["reused"] += pool.num_requests - pool.num_connections
+    return stats
+
+def get_user_info(auth_url, login, password, tenant_name, http=None):
     """Returns information about user."""
+    http = http or requests
     headers = {
         'Content-Type': "application/json",
         'Accept': "application/json"
@@ -180,7 +383,7 @@ def get_user_info(auth_url, login, password, tenant_name):
     }
 
     url = concat_url(auth_url, ENDPOINTS_INFO["IDENTITY"]["uri"]["TOKENS"])
-    r = requests.post(url, data=json.dumps(data), headers=headers, timeout=TIMEOUT)
+    r = http.post(url, data=json.dumps(data), headers=headers, timeout=TIMEOUT)
 
     if r.status_code not in [requests.status_codes.codes.ok,
                              requests.status_codes.codes.accepted]:
@@ -198,10 +401,17 @@ def get_service_catalog(services_list, region_name):
     return catalog
 
 @with_timeout(120)
-def wait_till_deleted(session, instance_name):
-    """Waits for instance deletion."""
-    while session.get_instance_info(instance_name):
-        time.sleep(1)
+def wait_till_deleted(session, instances, deadline=None):
+    """ Waits for instances deletion
+    (all pending instances are checked with a single call per poll)
+    """
+    pending = set(instances)
+    while True:
+        instances_details = session.get_instances_details(max_age=0)
+        pending.intersection_update(instances_details)
+        if not pending:
+            return
+        deadline.sleep(1)
 
 def get_fqdn(name, dns_zone):
     """Returns a fully qualified domain name for specified host name and DNS zone."""
@@ -0,0 +1,38 @@
+"""Test parameters module.
+
+Test parameters are combined from several layers (test suite global parameters,
+test parameters, run parameters and test suite overrides). ParamsView combines
+them without copying: a parameter is looked up from the last layer to the first one.
+
+"""
+
+import collections
+
+class ParamsView(collections.Mapping):
+    """Read-only view of layered parameters (later layers override earlier ones)."""
+    def __init__(self, *layers):
+        self.layers = [layer for layer in layers if layer]
+
+    def __getitem__(self, key):
+        for layer in reversed(self.layers):
+            if key in layer:
+                return layer[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        seen = set()
+        for layer in reversed(self.layers):
+            for key in layer:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return len(set().union(*self.layers))
+
+    def __repr__(self):
+        return "ParamsView({0})".format(dict(self))
+
+    def new_child(self, layer):
+        """Returns a view with one more layer on top."""
+        return ParamsView(*(self.layers + [layer]))
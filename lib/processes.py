@@ -0,0 +1,148 @@
+"""Subprocesses running module.
+
+This module runs several commands at once and streams their output
+line by line to stdout (each line can be formatted, e.g. prefixed with command's name).
+Running subprocesses can be terminated at once (e.g. when the tests run is aborted)
+and can be limited in time and resident memory. Every command runs in its own
+process group, so its descendants (e.g. ansible forks or ssh gateways) are
+signalled and limited together with it.
+
+"""
+
+import os
+import sys
+import errno
+import time
+import signal
+import select
+import subprocess
+import threading
+
+# Interval (in seconds) of checking subprocesses' limits
+LIMITS_CHECK_INTERVAL = 1
+
+_running = set()
+_lock = threading.RLock()
+
+def get_rss(pid):
+    """Returns resident set size of the process in MB (None if it's unknown)."""
+    try:
+        with open("/proc/{0}/status".format(pid)) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, ValueError):
+        pass
+    return None
+
+def get_group_rss(pgid):
+    """Returns total resident set size of the processes of the group in MB."""
+    total = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/{0}/stat".format(pid)) as stat:
+                # fields after the command name: state, ppid, pgrp, ...
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except IOError:
+            continue
+        if int(fields[2]) == pgid:
+            total += get_rss(pid) or 0
+    return total
+
+def _signal_group(process, signum):
+    """Sends the signal to the process and its descendants (its process group)."""
+    try:
+        os.killpg(process.pid, signum)
+    except OSError:
+        # the group doesn't exist anymore
+        pass
+
+def _check_limits(process, started, timeout, max_rss):
+    """Returns description of exceeded limit (None if the process is within limits)."""
+    if timeout and time.time() - started > timeout:
+        return "time limit of {0}s is exceeded".format(timeout)
+    if max_rss:
+        rss = get_group_rss(process.pid)
+        if rss > max_rss:
+            return "RSS limit of {0} MB is exceeded ({1:.0f} MB)".format(max_rss, rss)
+    return None
+
+def terminate_all():
+    """Terminates all running subprocesses (with their descendants)."""
+    with _lock:
+        for process in _running:
+            _signal_group(process, signal.SIGTERM)
+
+def run_concurrently(commands, formatter=None, on_line=None, timeout=None, max_rss=None):
+    """Runs commands concurrently and returns a dictionary: **name**: **exit code**.
+
+    commands -- dictionary: **name**: **command's arguments list**
+    formatter -- function(name, line) which returns a line to print
+    on_line -- function(name, line) which is called for every line of the output
+    timeout -- seconds after which a command is killed
+    max_rss -- resident set size (in MB) exceeding which a command is killed
+    """
+    formatter = formatter or (lambda name, line: line)
+    on_line = on_line or (lambda name, line: None)
+
+    def write(name, line):
+        on_line(name, line)
+        sys.stdout.write(formatter(name, line))
+
+    processes = {}
+    with _lock:
+        for name, cmd in commands.items():
+            processes[name] = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                               preexec_fn=os.setsid)
+        _running.update(processes.values())
+    started = time.time()
+    limited = timeout or max_rss
+
+    try:
+        pipes = {process.stdout.fileno(): name for name, process in processes.items()}
+        buffers = {name: '' for name in processes}
+        killed = set()
+        while pipes:
+            if limited:
+                # a command is running while its output is open (by it or its descendants)
+                for name in set(pipes.values()) - killed:
+                    exceeded = _check_limits(processes[name], started, timeout, max_rss)
+                    if exceeded:
+                        write(name, "Process is killed: {0}\n".format(exceeded))
+                        _signal_group(processes[name], signal.SIGKILL)
+                        killed.add(name)
+
+            try:
+                ready, _, _ = select.select(pipes.keys(), [], [],
+                                            LIMITS_CHECK_INTERVAL if limited else None)
+            except select.error as e:
+                # interrupted by a signal handler which didn't raise
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            for fd in ready:
+                name = pipes[fd]
+                data = os.read(fd, 4096)
+                if not data:
+                    if buffers[name]:
+                        write(name, buffers[name] + '\n')
+                    del pipes[fd]
+                    continue
+
+                lines = (buffers[name] + data).split('\n')
+                # keep incomplete line till the next read
+                buffers[name] = lines.pop()
+                for line in lines:
+                    write(name, line + '\n')
+            sys.stdout.flush()
+
+        return {name: process.wait() for name, process in processes.items()}
+    finally:
+        with _lock:
+            for process in processes.values():
+                if process.poll() is None:
+                    _signal_group(process, signal.SIGKILL)
+                    process.wait()
+            _running.difference_update(processes.values())
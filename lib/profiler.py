@@ -0,0 +1,118 @@
+"""Profiling module.
+
+This module records nested timing spans (with their attributes, e.g. hosts count,
+and counters increments, e.g. API calls count) and writes them as JSON profile
+and Chrome trace (it can be opened in chrome://tracing).
+
+It can be used as a decorator or with the with statement:
+    >>> with profiler.span("provisioning", key="provisioning", hosts=10):
+    ...     profiler.count("openstack_api_calls")
+    ...
+
+Spans with a key are also reported to TeamCity as build statistic values (in ms).
+
+"""
+
+import os
+import json
+import time
+import threading
+
+from collections import Counter
+from functools import wraps
+
+import teamcity_messages
+
+_spans = []
+_counters = Counter()
+_lock = threading.Lock()
+_local = threading.local()
+
+def _get_stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+def count(name, value=1):
+    """Increments the counter."""
+    with _lock:
+        _counters[name] += value
+
+class span(object):
+    """Records time spent in the block (nested spans are tracked per thread)."""
+    def __init__(self, name, key=None, **args):
+        self.name = name
+        self.key = key
+        self.args = args
+
+    def __call__(self, f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(self.name, self.key, **self.args):
+                return f(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        stack = _get_stack()
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+        with _lock:
+            self.counters = Counter(_counters)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        end = time.time()
+        self.duration = end - self.start
+        _get_stack().pop()
+        with _lock:
+            counters = Counter(_counters)
+            counters.subtract(self.counters)
+            _spans.append({"name": self.name,
+                           "parent": self.parent,
+                           "depth": self.depth,
+                           "start": self.start,
+                           "end": end,
+                           "duration": self.duration,
+                           "args": self.args,
+                           "counters": {k: v for k, v in counters.items() if v},
+                           "failed": type is not None,
+                           "pid": os.getpid(),
+                           "tid": threading.current_thread().ident})
+        if self.key:
+            teamcity_messages.report_statistic(self.key, int((end - self.start) * 1000))
+
+def reset():
+    """Forgets recorded spans and counters (e.g. in a forked child process)."""
+    with _lock:
+        del _spans[:]
+        _counters.clear()
+
+def get_profile():
+    """Returns recorded spans and counters."""
+    with _lock:
+        return {"spans": list(_spans), "counters": dict(_counters)}
+
+def get_profile_paths(directory, name="profile"):
+    """Returns paths of JSON profile and Chrome trace written by write_profile."""
+    return [os.path.join(directory, name + ".json"),
+            os.path.join(directory, name + ".trace.json")]
+
+def write_profile(directory, name="profile"):
+    """Writes JSON profile (**name**.json) and Chrome trace (**name**.trace.json)."""
+    profile = get_profile()
+    profile_path, trace_path = get_profile_paths(directory, name)
+    with open(profile_path, 'w') as profile_file:
+        json.dump(profile, profile_file, indent=4)
+
+    events = [{"name": s["name"],
+               "ph": "X",
+               "ts": int(s["start"] * 10 ** 6),
+               "dur": int(s["duration"] * 10 ** 6),
+               "pid": s["pid"],
+               "tid": s["tid"],
+               "args": dict(s["args"], **s["counters"])}
+              for s in profile["spans"]]
+    with open(trace_path, 'w') as trace_file:
+        json.dump({"traceEvents": events}, trace_file)
@@ -0,0 +1,66 @@
+"""Isolated pytest sessions module.
+
+Every pytest session runs in a separate process with its own temporary directory
+(pytest config, root directory and junit-xml report), so sessions don't share
+anything (they can run at once) and the runner doesn't accumulate pytest's
+plugins and modules. Sessions' results are read back from junit-xml reports.
+
+"""
+
+import os
+import sys
+import shlex
+import shutil
+import tempfile
+import ConfigParser
+import xml.etree.ElementTree as ElementTree
+
+from collections import namedtuple
+
+Results = namedtuple("Results", ["tests", "failures", "errors", "skipped", "failed"])
+
+class Session(object):
+    """Temporary directory of a pytest session."""
+    def __init__(self, name, addopts):
+        self.dir = tempfile.mkdtemp(prefix="pytest-{0}-".format(name))
+        self.cfg_path = os.path.join(self.dir, "pytest.ini")
+        self.junitxml_path = os.path.join(self.dir, "junit.xml")
+
+        pytest_config = ConfigParser.ConfigParser()
+        pytest_config.add_section("pytest")
+        pytest_config.set("pytest", "addopts", addopts)
+        with open(self.cfg_path, "w") as config_file:
+            pytest_config.write(config_file)
+
+    def get_command(self, opts):
+        """Returns command to run pytest session with given options."""
+        return [sys.executable, "-m", "pytest",
+                "-c", self.cfg_path,
+                "--rootdir", self.dir,
+                "--junitxml", self.junitxml_path] + shlex.split(opts)
+
+    def get_results(self):
+        """Returns session's results (None if the session didn't write the report)."""
+        if not os.path.exists(self.junitxml_path):
+            return None
+        return parse_junitxml(self.junitxml_path)
+
+    def remove(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def parse_junitxml(path):
+    """Returns results of tests from junit-xml report."""
+    tests, failures, errors, skipped = 0, 0, 0, 0
+    failed = []
+    for testcase in ElementTree.parse(path).getroot().iter("testcase"):
+        tests += 1
+        name = "{0}.{1}".format(testcase.get("classname"), testcase.get("name"))
+        if testcase.find("failure") is not None:
+            failures += 1
+            failed.append(name)
+        elif testcase.find("error") is not None:
+            errors += 1
+            failed.append(name)
+        elif testcase.find("skipped") is not None:
+            skipped += 1
+    return Results(tests, failures, errors, skipped, failed)
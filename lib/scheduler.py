@@ -0,0 +1,101 @@
+"""Tests scheduling module.
+
+This module allows to run tests concurrently: every test takes its own
+non-overlapping part of the inventory (clients and servers) and runs
+in a separate process. Tests can also be split into balanced shards
+which run on independent inventories.
+
+"""
+
+import os
+import sys
+import errno
+import signal
+import traceback
+
+class HostsPool(object):
+    """Keeps track of free clients and servers of an inventory."""
+    def __init__(self, inventory):
+        self.free = {"clients": list(inventory["clients"]),
+                     "servers": list(inventory["servers"])}
+
+    def acquire(self, clients_count, servers_count):
+        """Takes hosts for a test.
+        Returns an inventory with taken hosts or None if there are not enough free hosts.
+        """
+        if len(self.free["clients"]) < clients_count or \
+           len(self.free["servers"]) < servers_count:
+            return None
+
+        hosts = {"clients": self.free["clients"][:clients_count],
+                 "servers": self.free["servers"][:servers_count]}
+        del self.free["clients"][:clients_count]
+        del self.free["servers"][:servers_count]
+        return hosts
+
+    def release(self, hosts):
+        """Returns hosts to the pool."""
+        for hosts_type, names in hosts.items():
+            self.free[hosts_type].extend(names)
+
+def split_balanced(weights, count):
+    """Splits items into **count** shards with close total weights
+    (the heaviest item goes to the lightest shard first).
+    Returns a list of sets of items.
+
+    weights -- dictionary: **item**: **weight**
+    """
+    shards = [set() for _ in xrange(count)]
+    totals = [0] * count
+    for item in sorted(weights, key=lambda item: (-weights[item], item)):
+        lightest = totals.index(min(totals))
+        shards[lightest].add(item)
+        totals[lightest] += weights[item]
+    return shards
+
+def fork(func, log_path):
+    """Calls func in a child process and returns child's pid.
+    Child's stdout and stderr are redirected to log_path;
+    value returned by func is used as child's exit code.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    pid = os.fork()
+    if pid:
+        return pid
+
+    exitcode = 1
+    try:
+        log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        os.dup2(log_fd, sys.stdout.fileno())
+        os.dup2(log_fd, sys.stderr.fileno())
+        os.close(log_fd)
+        exitcode = func()
+    except:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exitcode)
+
+def wait():
+    """Waits for any child process; returns its pid and exit code."""
+    while True:
+        try:
+            pid, status = os.wait()
+            break
+        except OSError as e:
+            # interrupted by a signal handler (e.g. SIGTERM one)
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFEXITED(status):
+        return pid, os.WEXITSTATUS(status)
+    return pid, 1
+
+def terminate(pid):
+    """Asks the child process to stop (with SIGTERM)."""
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        pass
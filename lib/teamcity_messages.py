@@ -1,5 +1,9 @@
+import re
 import logging
 
+# flowId attribute of a service message (its value may contain escaped characters)
+_FLOW_ID_RE = re.compile(r"flowId='((?:\|.|[^'|])*)'")
+
 class block(object):
     """Prints teamcity service messages to combine output in a single block.
     There is a config file for the module (teamcity_messages.conf);
@@ -54,6 +58,28 @@ class block(object):
     def __exit__(self, type, value, traceback):
         self.close_block()
 
+class suite(object):
+    """Prints teamcity service messages to combine reported tests in a test suite.
+
+    It can be used with the with statement:
+    >>> with teamcity_messages.suite("test (attempt 2)"):
+    ...     teamcity_messages.report_test("test")
+    ... 
+    ##teamcity[testSuiteStarted name='test (attempt 2)']
+    ##teamcity[testStarted name='test']
+    ##teamcity[testFinished name='test']
+    ##teamcity[testSuiteFinished name='test (attempt 2)']
+    >>> 
+    """
+    def __init__(self, name):
+        self.name = name
+        self.logger = logging.getLogger('teamcity_logger')
+
+    def __enter__(self):
+        self.logger.info("##teamcity[testSuiteStarted name='{0}']".format(_escape(self.name)))
+
+    def __exit__(self, type, value, traceback):
+        self.logger.info("##teamcity[testSuiteFinished name='{0}']".format(_escape(self.name)))
 
 def _escape(text):
     """Escapes special TeamCity characters."""
@@ -86,3 +112,30 @@ def report_test(name, failed=False, message=None, details=None):
         logger.info(test_failed_msg)
 
     logger.info("##teamcity[testFinished name='{}']".format(name))
+
+def report_statistic(key, value):
+    """Prints service message for TeamCity to report build statistic value."""
+    logger = logging.getLogger('teamcity_logger')
+    logger.info("##teamcity[buildStatisticValue key='{}' value='{}']".format(_escape(key), value))
+
+def add_flow_id(line, flow_id):
+    """Adds flowId attribute to TeamCity service message in the line
+    (so TeamCity can separate messages from concurrent processes).
+    Existing flowId is prefixed with the given one: **flow_id**/**existing flowId**.
+    Returns None if the line doesn't contain a service message.
+    """
+    start = line.find("##teamcity[")
+    end = line.rfind("]")
+    if start == -1 or end < start:
+        return None
+    if _FLOW_ID_RE.search(line, start):
+        return _FLOW_ID_RE.sub(lambda match: "flowId='{}/{}'".format(_escape(flow_id), match.group(1)),
+                               line, count=1)
+    return "{} flowId='{}'{}".format(line[:end], _escape(flow_id), line[end:])
+
+def report_ignored(name, message):
+    """Prints service messages for TeamCity to report ignored (skipped) test."""
+    logger = logging.getLogger('teamcity_logger')
+    logger.info("##teamcity[testStarted name='{}']".format(_escape(name)))
+    logger.info("##teamcity[testIgnored name='{}' message='{}']".format(_escape(name), _escape(message)))
+    logger.info("##teamcity[testFinished name='{}']".format(_escape(name)))
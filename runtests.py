@@ -5,46 +5,55 @@ import argparse
 import os
 import json
 import sys
-import fnmatch
 import ConfigParser
-import pytest
-import subprocess
 import logging
 import traceback
-import copy
+import itertools
+import time
 
 from collections import OrderedDict
 
 import ansible_manager
 import instances_manager
 import teamcity_messages
+import scheduler
+import processes
+import configs_index
+import artifacts_uploader
+import profiler
+import pytest_sessions
+import aborting
+import durations
+from params import ParamsView
 import config_template_renderer as cfg_renderer
 
 # Exit codes
 EXIT_OK = 0
 EXIT_TESTSFAILED = 1
+# used by child processes in parallel mode when setup or teardown failed
+EXIT_TESTERROR = 2
 EXIT_INTERNALERROR = 3
 
 # Artifacts path
 ARTIFACTS_PATH = "/tmp/test-artifacts"
 
-# util functions
-def qa_storage_upload(file_path):
-    storage = "http://qa-storage.yandex-team.ru"
-    build_name = os.environ['TEAMCITY_BUILDCONF_NAME']
-    build_name = build_name.replace(' ', '_')
-    build_number = os.environ['BUILD_NUMBER']
-    file_name = os.path.basename(file_path)
-    url = '{storage}/upload/elliptics-testing/{build_name}/{build_number}/{file_name}'
-    url = url.format(storage=storage, build_name=build_name,
-                     build_number=build_number, file_name=file_name)
-
-    cmd = ["curl", url, "--data-binary", "@" + file_path]
-    subprocess.call(cmd)
+# Estimated duration (in seconds) of a test's run without history
+DEFAULT_RUN_DURATION = 600
 
-    url = url.replace("/upload/", "/get/")
-
-    return url
+# util functions
+def get_artifacts(artifacts_path, exclude=()):
+    """Returns paths of artifacts' files (except excluded paths)."""
+    paths = [os.path.join(artifacts_path, name) for name in sorted(os.listdir(artifacts_path))]
+    return [path for path in paths if os.path.isfile(path) and path not in exclude]
+
+def qa_storage_upload(paths, compress=False):
+    """Uploads artifacts to file storage and prints links to them."""
+    urls = artifacts_uploader.upload_artifacts(paths,
+                                               build_name=os.environ['TEAMCITY_BUILDCONF_NAME'],
+                                               build_number=os.environ['BUILD_NUMBER'],
+                                               compress=compress)
+    for path in paths:
+        print(urls[path] or "{0}: upload failed".format(os.path.basename(path)))
 
 class InfoFilter(logging.Filter):
     """Custom filter for runner_logger."""
@@ -88,6 +97,9 @@ def setup_loggers(teamcity, verbose):
 class TestError(Exception):
     pass
 
+class TeardownError(TestError):
+    pass
+
 class TestRunner(object):
     test_info = """
 ================================ Test Info: {0} ================================
@@ -98,7 +110,7 @@ Environment:
 ================================ Test Info: {0} ================================
 """
 
-    def __init__(self, args):
+    def __init__(self, args, shard=None):
         repo_dir = os.path.dirname(os.path.abspath(__file__))
         self.project_dir = os.path.abspath(os.path.join(repo_dir, ".."))
         self.ansible_dir = os.path.join(self.project_dir, "ansible")
@@ -111,11 +123,49 @@ Environment:
             self.testsuite_params = {}
 
         self.logger = logging.getLogger('runner_logger')
+        ansible_manager.LOGS_DIR = ARTIFACTS_PATH
         self.teamcity = args.teamcity
+        self.parallel = args.parallel
+        self.concurrent_clients = args.concurrent_clients
+        self.warm_pool = args.warm_pool
+        self.spare_instances = args.spare_instances
+        # Fixed inventory's hosts keep prepared environment between runs
+        self.force_prepare = args.force_prepare or not args.inventory
+        self.reuse_env = args.reuse_env
+        # abort policies
+        self.max_failures = args.max_failures
+        self.abort_setup_tags = args.abort_setup_tags
+        self.skipped = []
+        self.flaky = []
+        # limits of pytest sessions
+        self.pytest_timeout = args.pytest_timeout
+        self.pytest_max_rss = args.pytest_max_rss
+
+        self.durations_db = args.durations_db
+        self.estimates = durations.get_estimates(self.durations_db)
+        # tests which timed out last time are failed without running them
+        self.timing_out = durations.get_timed_out(self.durations_db) if args.fail_timing_out else set()
 
         self.tests = self._get_ordered_tests(args.tags)
-        self.inventory = self.get_inventory(args.inventory, args.instance_name)
-        self.tests = self.expand_tests_configs()
+        inventory_path = args.inventory[0] if args.inventory else None
+        instance_name = args.instance_name
+        # suffix of the testrunner's ansible files (they differ for concurrent shards)
+        self.files_suffix = ""
+        if shard:
+            index, count, shard_tests = shard
+            self.tests = OrderedDict((test_name, cfg) for test_name, cfg in self.tests.items()
+                                     if test_name in shard_tests)
+            inventory_path = args.inventory[index] if args.inventory else None
+            instance_name = "{0}-shard{1}".format(instance_name, index + 1)
+            self.files_suffix = "-shard{0}".format(index + 1)
+            if not self.tests:
+                self.logger.info("No tests for shard {0} of {1}.".format(index + 1, count))
+                self.inventory = None
+                return
+        self.compile_templates()
+        self.report_estimated_duration()
+
+        self.inventory = self.get_inventory(inventory_path, instance_name)
 
         with teamcity_messages.block("PREPARE TEST ENVIRONMENT"):
             self.prepare_ansible_test_files()
@@ -124,14 +174,9 @@ Environment:
     def _collect_tests(self, tags):
         """Collects tests' configs with given tags."""
         tests = {}
-        for root, _, filenames in os.walk(self.configs_dir):
-            for filename in fnmatch.filter(filenames, 'test_*.cfg'):
-                path = os.path.abspath(os.path.join(root, filename))
-                cfg = json.load(open(path))
-                if set(cfg["tags"]).intersection(set(tags)):
-                    # test config name format: "test_NAME.cfg"
-                    test_name = os.path.splitext(filename)[0][5:]
-                    tests[test_name] = cfg
+        for test_name, entry in configs_index.find_tests(self.configs_dir, tags).items():
+            with open(entry["path"]) as cfg_file:
+                tests[test_name] = json.load(cfg_file)
         return tests
 
     def _get_ordered_tests(self, tags):
@@ -142,12 +187,38 @@ Environment:
                     if params.get("order") == order]
 
         tests = self._collect_tests(tags)
+        # the longest tests go first within the same order
+        tests = OrderedDict(sorted(tests.items(), key=lambda (test_name, cfg): (
+            -self._estimate_duration(test_name, cfg), test_name)))
         ordered_tests = OrderedDict()
         ordered_tests.update(tests_with_order(tests, "tryfirst"))
         ordered_tests.update(tests_with_order(tests, None))
         ordered_tests.update(tests_with_order(tests, "trylast"))
         return ordered_tests
 
+    def compile_templates(self):
+        """Compiles running templates of all tests' runs, so a broken template
+        fails the run at start (runs are rendered just before running).
+        """
+        for test_name, cfg in self.tests.items():
+            for run in cfg["runs"]:
+                try:
+                    cfg_renderer.compile_template(os.path.join(self.configs_dir, run["path"]))
+                except Exception as exc:
+                    raise TestError("Running template {0} of test {1} is broken: {2}"
+                                    .format(run["path"], test_name, exc))
+
+    def _estimate_duration(self, test_name, cfg):
+        return estimate_duration(self.estimates, test_name, cfg)
+
+    def report_estimated_duration(self):
+        """Prints estimated total duration of the tests."""
+        total = sum(self._estimate_duration(test_name, cfg) for test_name, cfg in self.tests.items())
+        known = len([test_name for test_name in self.tests if test_name in self.estimates])
+        self.logger.info("Estimated tests' duration: {0:.1f} min ({1} of {2} tests have history)"
+                         .format(total / 60, known, len(self.tests)))
+        teamcity_messages.report_statistic("estimated_duration", int(total * 1000))
+
     def create_cloud_instances(self, instance_name):
         """Creates cloud instances and returns a dictionary with their names."""
         instances_names = {'client': "{0}-client".format(instance_name),
@@ -155,9 +226,12 @@ Environment:
 
         instances_params = instances_manager.get_instances_params(self.tests.values())
 
-        instances_cfg = instances_manager.get_instances_cfg(instances_params, instances_names)
+        instances_cfg = instances_manager.get_instances_cfg(instances_params, instances_names,
+                                                            self.spare_instances)
 
-        inventory = instances_manager.create(instances_cfg)
+        hosts_count = instances_cfg["clients"]["max_count"] + instances_cfg["servers"]["max_count"]
+        with profiler.span("provisioning", key="provisioning", hosts=hosts_count):
+            inventory = instances_manager.create(instances_cfg, warm_pool=self.warm_pool)
         if not inventory:
             raise RuntimeError("Not all nodes available")
 
@@ -172,21 +246,23 @@ Environment:
             inventory = self.create_cloud_instances(instance_name)
         return inventory
 
-    def expand_tests_configs(self):
-        """Expands test configs with running configuration parameters."""
-        tests = copy.deepcopy(self.tests)
-        for name, cfg in self.tests.items():
-            # expand running templates with test parameters and test environment
-            for i, run in enumerate(cfg["runs"]):
-                params = copy.deepcopy(cfg["params"])
-                params.update(run["params"])
-                run = cfg_renderer.get_running(os.path.join(self.configs_dir, run["path"]),
-                                               params,
-                                               self.inventory,
-                                               cfg["test_env_cfg"]["clients"]["count"],
-                                               cfg["test_env_cfg"]["servers"]["count_per_group"])
-                tests[name]["runs"][i].update(run)
-        return tests
+    def render_run(self, test_name, cfg, run):
+        """Returns test's run expanded with running configuration parameters
+        (it's rendered just before the run for current inventory).
+        """
+        # expand running template with test parameters and test environment
+        params = ParamsView(self.testsuite_params.get("_global"),
+                            cfg["params"],
+                            run["params"],
+                            self.testsuite_params.get(test_name))
+        running = cfg_renderer.get_running(os.path.join(self.configs_dir, run["path"]),
+                                           params,
+                                           self.inventory,
+                                           cfg["test_env_cfg"]["clients"]["count"],
+                                           cfg["test_env_cfg"]["servers"]["count_per_group"])
+        run = dict(run)
+        run.update(running)
+        return run
 
     def prepare_ansible_test_files(self):
         """Prepares ansible inventory and vars files for the tests."""
@@ -207,14 +283,14 @@ Environment:
                                                instances_names=self.inventory,
                                                ssh_user=self.user)
 
-            params = cfg["params"]
-            if name in self.testsuite_params:
-                params.update(self.testsuite_params[name])
+            params = ParamsView(cfg["params"], self.testsuite_params.get(name))
             vars_path = self._get_vars_path(groups['test'])
             ansible_manager.set_vars(vars_path=vars_path, params=params)
 
     def install_elliptics_packages(self):
-        """Installs elliptics packages on all servers and clients."""
+        """Installs elliptics packages on all servers and clients.
+        Hosts of fixed inventory which were prepared with the same playbook and vars are skipped.
+        """
         base_setup_playbook = "test-env-prepare"
         inventory_path = self.get_inventory_path(base_setup_playbook)
         groups = ansible_manager._get_groups_names("setup")
@@ -227,17 +303,28 @@ Environment:
                                            ssh_user=self.user)
 
         playbook = self.abspath(base_setup_playbook)
-        ansible_manager.run_playbook(playbook, inventory_path)
-
-    def generate_pytest_cfg(self, additional_options):
-        """Generates pytest.ini with test options."""
-        pytest_config = ConfigParser.ConfigParser()
-        pytest_config.add_section("pytest")
-        pytest_config.set("pytest", "addopts", additional_options)
-
-        self.logger.info("Test running options: {0}".format(additional_options))
-        with open("pytest.ini", "w") as config_file:
-            pytest_config.write(config_file)
+        extra_vars = {}
+        # the inventory is hashed too: hosts' groups and peers affect the environment
+        fingerprint = ansible_manager.get_fingerprint(playbook, extra_vars,
+                                                      [self._get_vars_path('test'), inventory_path])
+        hosts_fingerprints = {host: ansible_manager.get_host_fingerprint(fingerprint, host, self.user)
+                              for host in self.inventory['clients'] + self.inventory['servers']}
+
+        stamps_path = self.abspath("{0}{1}.stamps".format(base_setup_playbook, self.files_suffix))
+        stamps = {} if self.force_prepare else ansible_manager.read_stamps(stamps_path)
+        hosts = sorted(host for host, host_fingerprint in hosts_fingerprints.items()
+                       if stamps.get(host) != host_fingerprint)
+        if not hosts:
+            self.logger.info("Test environment is already prepared on all hosts.")
+            return
+
+        limit = hosts if len(hosts) < len(hosts_fingerprints) else None
+        with profiler.span("install_elliptics_packages", key="prepare", hosts=len(hosts)):
+            ansible_manager.run_playbook(playbook, inventory_path, extra_vars=extra_vars,
+                                         limit=limit)
+
+        stamps.update((host, hosts_fingerprints[host]) for host in hosts)
+        ansible_manager.write_stamps(stamps_path, stamps)
 
     def setup(self, test_name, env_cfg, run, extra_vars):
         playbook = self.abspath(env_cfg["setup_playbook"])
@@ -251,10 +338,6 @@ Environment:
                                           message=exc.message, details=exc_info)
             raise TestError("Setup for test {} raised exception: {}".format(test_name, exc_info))
 
-        # Check if it's a pytest test
-        if run["type"] == "pytest":
-            self.generate_pytest_cfg(run["addopts"])
-
     def run_playbook_test(self, test_name, run, extra_vars):
         playbook = self.abspath(run["playbook"])
         inventory = self.get_inventory_path(test_name)
@@ -265,40 +348,103 @@ Environment:
             return False
         return True
 
-    def run_pytest_test(self, test_name, run, env_cfg):
+    def get_pytest_opts(self, test_name, run, client_name):
+        """Returns pytest options to run the test from the client."""
         rsyncdir_opts = "--rsyncdir {0}/tests/ --rsyncdir {0}/lib/test_helper"
         rsyncdir_opts = rsyncdir_opts.format(self.project_dir)
 
-        succeded = True
-        clients_count = env_cfg["clients"]["count"]
-        for client_name in self.inventory["clients"][:clients_count]:
-            if self.teamcity:
-                opts = '--teamcity'
-            else:
-                opts = ''
-            opts += ' -d --tx ssh="{host} -l {user} -q" {rsyncdir_opts} {prj_dir}/tests/{target}'
-
-            opts = opts.format(host=client_name,
-                               user=self.user,
-                               rsyncdir_opts=rsyncdir_opts,
-                               prj_dir=self.project_dir,
-                               target=run["target"])
-            self.logger.info(opts)
-
-            exitcode = pytest.main(opts)
-            if exitcode:
-                succeded = False
-
-        return succeded
-
-    def run(self, test_name, run, env_cfg, extra_vars):
+        if self.teamcity:
+            opts = '--teamcity'
+        else:
+            opts = ''
+        opts += ' -d --tx ssh="{host} -l {user} -q" {rsyncdir_opts} {prj_dir}/tests/{target}'
+
+        opts = opts.format(host=client_name,
+                           user=self.user,
+                           rsyncdir_opts=rsyncdir_opts,
+                           prj_dir=self.project_dir,
+                           target=run["target"])
+        return opts
+
+    def run_pytest_test(self, test_name, run, env_cfg, clients=None):
+        """Runs pytest test from the clients (all test's clients by default)
+        and returns failed clients.
+        """
+        if clients is None:
+            clients_count = env_cfg["clients"]["count"]
+            clients = self.inventory["clients"][:clients_count]
+        if self.concurrent_clients:
+            return self.run_pytest_sessions(test_name, run, clients)
+
+        failed_clients = []
+        for client_name in clients:
+            failed_clients += self.run_pytest_sessions(test_name, run, [client_name])
+        return failed_clients
+
+    def run_pytest_sessions(self, test_name, run, clients):
+        """Runs isolated pytest sessions from the clients at once (in separate processes)
+        and returns failed clients.
+        """
+        self.logger.info("Test running options: {0}".format(run["addopts"]))
+        sessions = {}
+        commands = {}
+        try:
+            for client_name in clients:
+                opts = self.get_pytest_opts(test_name, run, client_name)
+                self.logger.info(opts)
+                sessions[client_name] = pytest_sessions.Session(test_name, run["addopts"])
+                commands[client_name] = sessions[client_name].get_command(opts)
+
+            formatter = self._format_client_output if len(clients) > 1 else None
+            exitcodes = processes.run_concurrently(commands, formatter,
+                                                   timeout=self.pytest_timeout,
+                                                   max_rss=self.pytest_max_rss)
+
+            failed_clients = []
+            for client_name in clients:
+                results = sessions[client_name].get_results()
+                self.report_pytest_results(run["test_name"], client_name,
+                                           exitcodes[client_name], results)
+                if exitcodes[client_name] or results is None:
+                    failed_clients.append(client_name)
+            return failed_clients
+        finally:
+            for session in sessions.values():
+                session.remove()
+
+    def report_pytest_results(self, run_name, client_name, exitcode, results):
+        """Prints results of client's pytest session read from its junit-xml report."""
+        if results is None:
+            message = "pytest session didn't finish (exit code: {0})".format(exitcode)
+            self.logger.error("{0} on {1}: {2}".format(run_name, client_name, message))
+            teamcity_messages.report_test("test_{0}_{1}_session".format(run_name, client_name),
+                                          failed=True, message=message)
+            return
+
+        self.logger.info("{0} on {1}: {2} tests, {3} failures, {4} errors, {5} skipped".format(
+            run_name, client_name, results.tests, results.failures, results.errors, results.skipped))
+        if results.failed:
+            self.logger.info("Failed tests:\n\t{0}".format("\n\t".join(results.failed)))
+
+    def _format_client_output(self, client_name, line):
+        """Marks client's output line with TeamCity flowId or with client's name."""
+        flow_line = teamcity_messages.add_flow_id(line, client_name)
+        if flow_line is not None:
+            return flow_line
+        return "[{0}] {1}".format(client_name, line)
+
+    def run(self, test_name, run, env_cfg, extra_vars, clients=None):
+        """Runs the run and returns a tuple: (**succeeded**, **failed clients**)
+        (failed clients are known only for pytest runs, otherwise they are None).
+        """
         if run["type"] == "ansible":
-            return self.run_playbook_test(test_name, run, extra_vars)
+            return self.run_playbook_test(test_name, run, extra_vars), None
         elif run["type"] == "pytest":
-            return self.run_pytest_test(test_name, run, env_cfg)
+            failed_clients = self.run_pytest_test(test_name, run, env_cfg, clients)
+            return not failed_clients, failed_clients
         else:
             self.logger.info("Can't determine running method for {0} test.\n".format(test_name))
-            return False
+            return False, None
 
     def teardown(self, test_name, run, env_cfg, extra_vars):
         """Does clean-up steps after a test."""
@@ -310,70 +456,567 @@ Environment:
             exc_info = traceback.format_exc()
             teamcity_messages.report_test("test_" + test_name + "_teardown", failed=True,
                                           message=exc.message, details=exc_info)
-            raise TestError("Teardown for test {} raised exception: {}".format(test_name, exc_info))
+            raise TeardownError("Teardown for test {} raised exception: {}".format(test_name, exc_info))
+
+    def _get_env_key(self, cfg, run):
+        """Returns a key which is the same for runs with the same test environment.
+        Only run parameters listed in "setup_vars" of test environment config are
+        taken into account (all parameters if "setup_vars" isn't specified).
+        """
+        env_cfg = cfg["test_env_cfg"]
+        setup_vars = env_cfg.get("setup_vars")
+        if setup_vars is None:
+            params = run["params"]
+        else:
+            params = {name: run["params"].get(name) for name in setup_vars}
+        return json.dumps([env_cfg, params], sort_keys=True)
+
+    def _group_runs_by_env(self, cfg):
+        """Returns test's runs reordered so the runs with the same environment are consecutive."""
+        groups = OrderedDict()
+        for run in cfg["runs"]:
+            groups.setdefault(self._get_env_key(cfg, run), []).append(run)
+        return list(itertools.chain.from_iterable(groups.values()))
+
+    def run_test(self, test_name, cfg):
+        """Runs all runs of a test and returns a number of failed runs.
+        In environment reuse mode consecutive runs with the same environment
+        share a single setup and teardown.
+
+        Setups and runs are interrupted when the test exceeds its time budget
+        ("timeout" in seconds for all test's runs). When the whole run is aborted
+        (e.g. teardown failed), remaining runs are skipped (test environment is torn down anyway).
+        """
+        if test_name in self.timing_out:
+            teamcity_messages.report_test("test_" + test_name, failed=True,
+                                          message="Test timed out last time, it isn't run again")
+            return len(cfg["runs"])
+
+        testsfailed = 0
+        error = None
+        env_is_set = False
+        started = time.time()
+        runs = self._group_runs_by_env(cfg) if self.reuse_env else cfg["runs"]
+        env_keys = [self._get_env_key(cfg, run) for run in runs]
+        for i, run in enumerate(runs):
+            if aborting.get_reason():
+                run_name = self._get_run_name(test_name, cfg, run, i)
+                with teamcity_messages.block("TEST: {}".format(run_name)):
+                    self.skip_run(run_name, aborting.get_reason())
+                    if env_is_set:
+                        env_is_set = False
+                        error = self._teardown_env_or_abort(test_name, cfg, env_run) or error
+                continue
+
+            try:
+                run = self.render_run(test_name, cfg, run)
+            except Exception as exc:
+                testsfailed += 1
+                teamcity_messages.report_test("test_" + test_name + "_render", failed=True,
+                                              message=str(exc), details=traceback.format_exc())
+                if env_is_set:
+                    # the environment kept for this run isn't needed anymore
+                    env_is_set = False
+                    error = self._teardown_env_or_abort(test_name, cfg, env_run) or error
+                continue
+            # Expand extra ansible variables with special fields
+            extra_vars = dict(run["params"], test_name=run["test_name"])
+            env_is_broken = False
+            with teamcity_messages.block("TEST: {}".format(run["test_name"])):
+                env_cfg = cfg["test_env_cfg"]
+                test_info = self.test_info.format(run["test_name"],
+                                                  run["description"],
+                                                  env_cfg["clients"]["count"],
+                                                  env_cfg["servers"]["count_per_group"])
+                self.logger.info(test_info)
+
+                reuse_env = env_is_set
+                # the environment is torn down even if its setup failed
+                env_is_set = True
+                env_run = (run, extra_vars)
+                try:
+                    if not self.run_attempts(test_name, cfg, run, extra_vars, started, reuse_env):
+                        testsfailed += 1
+                except TeardownError as exc:
+                    # teardown before a retry failed; the environment isn't torn down again
+                    env_is_set = False
+                    testsfailed += 1
+                    aborting.abort("teardown of test {} failed".format(test_name))
+                    error = exc
+                except TestError as exc:
+                    # setup failed, so the environment can't be reused
+                    env_is_broken = True
+                    testsfailed += 1
+                    if self._aborts_on_setup_failure(cfg):
+                        aborting.abort("setup of test {} failed".format(test_name))
+                        error = exc
+                except aborting.TimeBudgetExceeded as exc:
+                    # the environment could be left in the middle of setup or run
+                    env_is_broken = True
+                    testsfailed += 1
+                    teamcity_messages.report_test("test_" + run["test_name"] + "_timeout",
+                                                  failed=True, message=str(exc))
+                except aborting.Aborted as exc:
+                    testsfailed += 1
+                    self.logger.error("Test {} was interrupted: {}".format(run["test_name"], exc))
+
+                keep_env = self.reuse_env and i + 1 < len(runs) and env_keys[i + 1] == env_keys[i]
+                if env_is_set and keep_env and not env_is_broken and not aborting.get_reason():
+                    self.logger.info("Keeping test environment for the next run.")
+                elif env_is_set:
+                    env_is_set = False
+                    error = self._teardown_env_or_abort(test_name, cfg, env_run) or error
+
+        if error:
+            raise error
+        return testsfailed
+
+    def _teardown_env_or_abort(self, test_name, cfg, env_run):
+        """Tears down test environment of the run; aborts the whole run if teardown failed.
+        Returns the teardown error (None if teardown succeeded).
+        """
+        try:
+            self.teardown_env(test_name, cfg, *env_run)
+        except TeardownError as exc:
+            aborting.abort("teardown of test {} failed".format(test_name))
+            return exc
+        return None
+
+    def run_attempts(self, test_name, cfg, run, extra_vars, started, reuse_env=False):
+        """Runs the run and retries it if it failed (up to test's "retries" times).
+        Returns True if the run succeeded.
+
+        Attempts share test's time budget (counted from **started**).
+        Every retry is done in a fresh test environment; a pytest run is retried
+        only from failed clients. Retries are reported to TeamCity as separate test suites
+        and every attempt of a retried run is reported as a separate test ("test_RUN_attemptN");
+        runs which succeeded on a retry are recorded as flaky.
+        """
+        retries = cfg.get("retries", 0)
+        succeeded, clients = self.run_attempt(test_name, cfg, run, extra_vars, started,
+                                              reuse_env=reuse_env, retry=retries > 0)
+        attempt = 1
+        if retries:
+            self.report_attempt(run["test_name"], attempt, succeeded, clients)
+        while not succeeded and attempt <= retries:
+            attempt += 1
+            self.logger.info("Retrying test {} (attempt {} of {}){}".format(
+                run["test_name"], attempt, retries + 1,
+                " on clients: {}".format(", ".join(clients)) if clients else ""))
+
+            with teamcity_messages.suite("{} (attempt {})".format(run["test_name"], attempt)):
+                # teardown failure (TeardownError) isn't a failed setup, it stops the retries
+                self.teardown_env(test_name, cfg, run, extra_vars)
+                retried_clients = clients
+                succeeded, clients = self.run_attempt(test_name, cfg, run, extra_vars, started,
+                                                      clients=retried_clients,
+                                                      retry=attempt <= retries)
+                self.report_attempt(run["test_name"], attempt, succeeded, clients)
+            if succeeded:
+                self.record_flaky(test_name, run["test_name"], attempt, retried_clients)
+        return succeeded
+
+    def report_attempt(self, run_name, attempt, succeeded, failed_clients):
+        """Reports result of the run's attempt to TeamCity as a separate test."""
+        message = None
+        if not succeeded:
+            message = "Attempt {} failed{}".format(
+                attempt, " on clients: {}".format(", ".join(failed_clients)) if failed_clients else "")
+        teamcity_messages.report_test("test_{}_attempt{}".format(run_name, attempt),
+                                      failed=not succeeded, message=message)
+
+    def run_attempt(self, test_name, cfg, run, extra_vars, started, reuse_env=False, clients=None,
+                    retry=False):
+        """Sets up test environment (if it isn't reused) and runs the run.
+        Returns a tuple: (**succeeded**, **failed clients**) (see run method);
+        failed setup is treated as failed run if the run is going to be retried.
+        """
+        if reuse_env:
+            self.logger.info("Reusing test environment of the previous run.")
+        else:
+            try:
+                self.setup_env(test_name, cfg, run, extra_vars, started)
+            except TestError:
+                if not retry:
+                    raise
+                return False, None
+
+        with profiler.span("run", key="test.{}.run".format(run["test_name"]),
+                           test=run["test_name"]) as span:
+            try:
+                with aborting.guard(cfg.get("timeout"), started):
+                    result = self.run(test_name, run, cfg["test_env_cfg"], extra_vars, clients)
+            except aborting.TimeBudgetExceeded:
+                self.record_duration(test_name, cfg, run, "run", time.time() - span.start,
+                                     timed_out=True)
+                raise
+        self.record_duration(test_name, cfg, run, "run", span.duration)
+        return result
+
+    def setup_env(self, test_name, cfg, run, extra_vars, started):
+        """Sets up test environment of the run (it can be interrupted, e.g. when test's
+        time budget counted from **started** is exceeded).
+        """
+        with profiler.span("setup", key="test.{}.setup".format(run["test_name"])) as span, \
+             aborting.guard(cfg.get("timeout"), started):
+            self.setup(test_name, cfg["test_env_cfg"], run, extra_vars)
+        self.record_duration(test_name, cfg, run, "setup", span.duration)
+
+    def teardown_env(self, test_name, cfg, run, extra_vars):
+        """Tears down test environment of the run."""
+        with profiler.span("teardown", key="test.{}.teardown".format(run["test_name"])) as span:
+            self.teardown(test_name, run, cfg["test_env_cfg"], extra_vars)
+        self.record_duration(test_name, cfg, run, "teardown", span.duration)
+
+    def record_flaky(self, test_name, run_name, attempt, clients):
+        """Records the run which succeeded only on a retry
+        (the runs are appended to flaky_tests.jsonl artifact).
+        """
+        flaky = {"test": test_name, "run": run_name, "attempt": attempt, "clients": clients}
+        self.flaky.append(flaky)
+        if not os.path.exists(ARTIFACTS_PATH):
+            os.makedirs(ARTIFACTS_PATH)
+        with open(os.path.join(ARTIFACTS_PATH, "flaky_tests.jsonl"), 'a') as flaky_file:
+            flaky_file.write(json.dumps(flaky) + "\n")
+
+    def report_flaky(self):
+        """Prints summary of flaky runs."""
+        if self.flaky:
+            self.logger.info("Flaky runs (succeeded only on a retry):\n\t{}".format(
+                "\n\t".join("{run} (attempt {attempt})".format(**flaky) for flaky in self.flaky)))
+
+    def _aborts_on_setup_failure(self, cfg):
+        """Checks if failed setup of the test aborts the run
+        (any failed setup does if tags to abort on aren't specified).
+        """
+        if self.abort_setup_tags is None:
+            return True
+        return bool(set(self.abort_setup_tags).intersection(cfg["tags"]))
+
+    def skip_run(self, run_name, reason):
+        """Reports the run as ignored."""
+        self.logger.info("Test {} is skipped: {}".format(run_name, reason))
+        teamcity_messages.report_ignored(run_name, reason)
+        self.skipped.append(run_name)
+
+    def _get_run_name(self, test_name, cfg, run, index):
+        """Returns name of test's run (a name made of test's name if the run can't be rendered)."""
+        try:
+            return self.render_run(test_name, cfg, run)["test_name"]
+        except Exception:
+            return "{}_run{}".format(test_name, index + 1)
+
+    def skip_test(self, test_name, cfg, reason):
+        """Reports all runs of the test as ignored."""
+        for i, run in enumerate(cfg["runs"]):
+            run_name = self._get_run_name(test_name, cfg, run, i)
+            with teamcity_messages.block("TEST: {}".format(run_name)):
+                self.skip_run(run_name, reason)
+
+    def report_skipped(self):
+        """Prints summary of skipped runs."""
+        if self.skipped:
+            self.logger.error("Tests run was aborted ({}), skipped {} runs:\n\t{}".format(
+                aborting.get_reason(), len(self.skipped), "\n\t".join(self.skipped)))
+
+    def _check_max_failures(self, failures):
+        """Aborts the run if there are too many failed tests."""
+        if self.max_failures and failures >= self.max_failures:
+            aborting.abort("{} tests failed".format(failures))
+
+    def record_duration(self, test_name, cfg, run, stage, duration, timed_out=False):
+        """Stores duration of the run's stage in durations history.
+        The run is timed out if it took longer than test's "timeout" (in seconds).
+        """
+        timed_out = timed_out or (stage == "run" and duration > cfg.get("timeout", float("inf")))
+        durations.record(self.durations_db, test_name, run["test_name"], stage, duration, timed_out)
 
     def run_tests(self):
+        if self.parallel:
+            return self.run_tests_parallel()
+
+        aborting.handle_sigterm()
         testsfailed = 0
+        failures = 0
+        error = None
         for test_name, cfg in self.tests.items():
-            for run in cfg["runs"]:
-                with teamcity_messages.block("TEST: {}".format(run["test_name"])):
-                    env_cfg = cfg["test_env_cfg"]
-                    test_info = self.test_info.format(run["test_name"],
-                                                      run["description"],
-                                                      env_cfg["clients"]["count"],
-                                                      env_cfg["servers"]["count_per_group"])
-                    self.logger.info(test_info)
-                    
-                    extra_vars = copy.deepcopy(run["params"])
-                    # Expand extra ansible variables with special fields
-                    extra_vars.update({"test_name": run["test_name"]})
-                    
-                    self.setup(test_name, cfg["test_env_cfg"], run, extra_vars)
-
-                    if not self.run(test_name, run, cfg["test_env_cfg"], extra_vars):
-                        testsfailed += 1
+            if aborting.get_reason():
+                self.skip_test(test_name, cfg, aborting.get_reason())
+                continue
+
+            try:
+                failed = self.run_test(test_name, cfg)
+            except TestError as exc:
+                aborting.abort("setup or teardown of test {} failed".format(test_name))
+                error = exc
+                continue
+            if failed:
+                testsfailed += failed
+                failures += 1
+                self._check_max_failures(failures)
+        self.report_flaky()
+        self.report_skipped()
+
+        if error:
+            raise error
+        if testsfailed:
+            return False
+        else:
+            return True
+
+    def run_tests_parallel(self):
+        """Runs tests concurrently on non-overlapping parts of the inventory.
 
-                    self.teardown(test_name, run, cfg["test_env_cfg"], extra_vars)
+        Tests with the same order ("tryfirst", default, "trylast") are packed onto
+        free clients and servers; the next order starts when all previous tests finished.
+        When the run is aborted, running tests are terminated (they are torn down anyway)
+        and pending tests are skipped.
+        """
+        if not os.path.exists(ARTIFACTS_PATH):
+            os.makedirs(ARTIFACTS_PATH)
+
+        testsfailed = 0
+        testerror = False
+        running = {}
+        terminated = set()
+        parent_pid = os.getpid()
+
+        def terminate_running():
+            # forked child can get SIGTERM before it sets its own handler
+            if os.getpid() != parent_pid:
+                return
+            for pid in set(running) - terminated:
+                scheduler.terminate(pid)
+                terminated.add(pid)
+        aborting.handle_sigterm(terminate_running)
+
+        for _, tests in itertools.groupby(self.tests.items(), lambda test: test[1].get("order")):
+            pending = list(tests)
+            hosts_pool = scheduler.HostsPool(self.inventory)
+            while pending or running:
+                for test_name, cfg in list(pending):
+                    if aborting.get_reason():
+                        pending.remove((test_name, cfg))
+                        self.skip_test(test_name, cfg, aborting.get_reason())
+                        continue
+                    env_cfg = cfg["test_env_cfg"]
+                    hosts = hosts_pool.acquire(env_cfg["clients"]["count"],
+                                               sum(env_cfg["servers"]["count_per_group"]))
+                    if hosts is None:
+                        continue
+                    pending.remove((test_name, cfg))
+                    log_path = os.path.join(ARTIFACTS_PATH, "test_{}.log".format(test_name))
+                    pid = scheduler.fork(lambda: self._run_test_on_hosts(test_name, cfg, hosts),
+                                         log_path)
+                    running[pid] = (test_name, hosts, log_path)
+
+                if not running:
+                    if pending:
+                        raise TestError("Not enough hosts in the inventory for tests: {}"
+                                        .format(", ".join(name for name, _ in pending)))
+                    break
+
+                pid, exitcode = scheduler.wait()
+                test_name, hosts, log_path = running.pop(pid)
+                hosts_pool.release(hosts)
+
+                # Print test's output as a single block
+                with teamcity_messages.block("TEST: {}".format(test_name)):
+                    with open(log_path) as log:
+                        for line in log:
+                            sys.stdout.write(line)
+                    sys.stdout.flush()
+
+                if exitcode == EXIT_TESTERROR:
+                    testerror = True
+                    aborting.abort("setup or teardown of test {} failed".format(test_name))
+                elif exitcode != EXIT_OK:
+                    testsfailed += 1
+                    self._check_max_failures(testsfailed)
+
+                if aborting.get_reason():
+                    terminate_running()
+        self.report_skipped()
+
+        if testerror:
+            raise TestError("Setup or teardown failed in parallel mode (see the tests' output)")
 
         if testsfailed:
             return False
         else:
             return True
 
+    def _run_test_on_hosts(self, test_name, cfg, hosts):
+        """Runs a test on a part of the inventory (it's called in a child process)."""
+        env_cfg = cfg["test_env_cfg"]
+        ansible_manager.generate_inventory(inventory_path=self.get_inventory_path(test_name),
+                                           clients_count=env_cfg["clients"]["count"],
+                                           servers_per_group=env_cfg["servers"]["count_per_group"],
+                                           groups=ansible_manager._get_groups_names(test_name),
+                                           instances_names=hosts,
+                                           ssh_user=self.user)
+        self.inventory = hosts
+        profiler.reset()
+        aborting.handle_sigterm()
+
+        try:
+            if self.run_test(test_name, cfg):
+                return EXIT_TESTSFAILED
+        except TestError:
+            traceback.print_exc()
+            return EXIT_TESTERROR
+        finally:
+            self.report_flaky()
+            profiler.write_profile(ARTIFACTS_PATH, "profile-test_{}".format(test_name))
+        return EXIT_OK
+
     def abspath(self, path):
         abs_path = os.path.join(self.ansible_dir, path)
         return abs_path
 
     def get_inventory_path(self, name):
-        path = self.abspath("{0}.hosts".format(name))
+        path = self.abspath("{0}{1}.hosts".format(name, self.files_suffix))
         return path
 
     def _get_vars_path(self, name):
         path = self.abspath("group_vars/{0}.json".format(name))
         return path
 
+def list_tests(args):
+    """Prints tests with given tags or all tests (without preparing test environment)."""
+    configs_dir = os.path.abspath(os.path.expanduser(args.configs_dir))
+    tests = configs_index.find_tests(configs_dir, args.tags)
+    for test_name, entry in sorted(tests.items()):
+        print("{0}\t{1}\t{2}".format(test_name, entry["order"] or "-", entry["path"]))
+    return EXIT_OK
+
+def estimate_duration(estimates, test_name, cfg):
+    """Returns estimated duration of the test (in seconds) based on durations history.
+    Runs without history are estimated as an average known run.
+    """
+    runs_count = len(cfg["runs"])
+    if test_name in estimates:
+        duration, known_runs = estimates[test_name]
+        return duration / known_runs * runs_count
+
+    known_runs = sum(runs for _, runs in estimates.values())
+    if not known_runs:
+        return DEFAULT_RUN_DURATION * runs_count
+    total = sum(duration for duration, _ in estimates.values())
+    return total / known_runs * runs_count
+
+def split_tests(args, count):
+    """Splits tests into **count** shards with close estimated durations.
+    Returns a list of sets of tests' names.
+    """
+    configs_dir = os.path.abspath(os.path.expanduser(args.configs_dir))
+    estimates = durations.get_estimates(args.durations_db)
+    weights = {}
+    for test_name, entry in configs_index.find_tests(configs_dir, args.tags).items():
+        with open(entry["path"]) as cfg_file:
+            weights[test_name] = estimate_duration(estimates, test_name, json.load(cfg_file))
+    return scheduler.split_balanced(weights, count)
+
+def get_shards_count(args):
+    """Returns number of shards (one per inventory or per cloud cluster)."""
+    if args.inventory:
+        return len(args.inventory)
+    return args.shards
+
+def run_testrunner(args, shard=None):
+    """Runs tests (of the shard) and returns exit code."""
+    try:
+        testrunner = TestRunner(args, shard)
+        if not testrunner.run_tests():
+            return EXIT_TESTSFAILED
+    except TestError:
+        traceback.print_exc(file=sys.stderr)
+        return EXIT_TESTSFAILED
+    except:
+        traceback.print_exc(file=sys.stderr)
+        return EXIT_INTERNALERROR
+    return EXIT_OK
+
+def run_shard(args, index, count, shard_tests):
+    """Runs tests of the shard (it's called in a child process)."""
+    profiler.reset()
+    try:
+        return run_testrunner(args, (index, count, shard_tests))
+    finally:
+        profiler.write_profile(ARTIFACTS_PATH, "profile-shard{0}".format(index + 1))
+
+def run_shards(args, count):
+    """Runs shards of the tests concurrently (each shard on its own inventory)
+    and returns the worst of shards' exit codes.
+    """
+    if not os.path.exists(ARTIFACTS_PATH):
+        os.makedirs(ARTIFACTS_PATH)
+
+    # the split is done once: shards update durations history while running
+    shards_tests = split_tests(args, count)
+
+    running = {}
+    parent_pid = os.getpid()
+
+    def terminate_running():
+        # forked shard can get SIGTERM before it sets its own handler
+        if os.getpid() != parent_pid:
+            return
+        # shards tear down their tests and exit, their output is printed below
+        for pid in running:
+            scheduler.terminate(pid)
+    aborting.handle_sigterm(terminate_running)
+
+    for index in xrange(count):
+        log_path = os.path.join(ARTIFACTS_PATH, "shard{0}.log".format(index + 1))
+        pid = scheduler.fork(lambda: run_shard(args, index, count, shards_tests[index]), log_path)
+        running[pid] = (index, log_path)
+
+    exitcode = EXIT_OK
+    while running:
+        pid, shard_exitcode = scheduler.wait()
+        index, log_path = running.pop(pid)
+
+        # Print shard's output as a single block
+        with teamcity_messages.block("SHARD: {0} of {1}".format(index + 1, count)):
+            with open(log_path) as log:
+                for line in log:
+                    sys.stdout.write(line)
+            sys.stdout.flush()
+
+        exitcode = max(exitcode, shard_exitcode)
+    return exitcode
+
 def main(args):
+    if args.list_tests:
+        return list_tests(args)
+
     exitcode = EXIT_OK
 
     try:
         setup_loggers(args.teamcity, args.verbose)
 
-        testrunner = TestRunner(args)
-        if not testrunner.run_tests():
-            exitcode = EXIT_TESTSFAILED
-
-    except TestError:
-        traceback.print_exc(file=sys.stderr)
-        exitcode = EXIT_TESTSFAILED
+        shards_count = get_shards_count(args)
+        if shards_count > 1:
+            exitcode = run_shards(args, shards_count)
+        else:
+            exitcode = run_testrunner(args)
     except:
         traceback.print_exc(file=sys.stderr)
         exitcode = EXIT_INTERNALERROR
     finally:
         if args.teamcity:
             # Upload artifacts to file storage
+            profile_paths = profiler.get_profile_paths(ARTIFACTS_PATH)
             with teamcity_messages.block("LOGS: Links"):
-                for artifacts in os.listdir(ARTIFACTS_PATH):
-                    print(qa_storage_upload(os.path.join(ARTIFACTS_PATH, artifacts)))
+                with profiler.span("artifacts_upload", key="artifacts_upload"):
+                    qa_storage_upload(get_artifacts(ARTIFACTS_PATH, exclude=profile_paths),
+                                      args.compress_artifacts)
+                # the profile is written after the upload (so it includes the upload) and uploaded last
+                profiler.write_profile(ARTIFACTS_PATH)
+                qa_storage_upload(profile_paths, args.compress_artifacts)
+        elif os.path.exists(ARTIFACTS_PATH):
+            profiler.write_profile(ARTIFACTS_PATH)
 
     return exitcode
 
@@ -393,12 +1036,56 @@ if __name__ == "__main__":
                         help="will format output with Teamcity messages.")
     parser.add_argument('--user', default="root",
                         help="a user which will be used to connect via ssh to test machines.")
-
-    group = parser.add_mutually_exclusive_group(required=True)
-    group.add_argument('--inventory', help="path to inventory file.")
-    group.add_argument('--instance-name', dest="instance_name", default="elliptics",
-                       help="base name for the instances.")
+    parser.add_argument('--parallel', action="store_true", dest="parallel",
+                        help="run tests concurrently on non-overlapping parts of the inventory.")
+    parser.add_argument('--concurrent-clients', action="store_true", dest="concurrent_clients",
+                        help="run pytest tests from all clients at once.")
+    parser.add_argument('--warm-pool', action="store_true", dest="warm_pool",
+                        help="reuse or rebuild suitable existing instances instead of recreating them.")
+    parser.add_argument('--spare-instances', type=int, default=0, dest="spare_instances",
+                        help="number of additional instances of each type kept booted for next runs "
+                        "(with --warm-pool).")
+    parser.add_argument('--force-prepare', action="store_true", dest="force_prepare",
+                        help="prepare test environment on all hosts even if it's already prepared.")
+    parser.add_argument('--reuse-env', action="store_true", dest="reuse_env",
+                        help="group test's runs with the same environment and set it up only once.")
+    parser.add_argument('--list', action="store_true", dest="list_tests",
+                        help="list tests with given tags and exit.")
+    parser.add_argument('--compress-artifacts', action="store_true", dest="compress_artifacts",
+                        help="upload artifacts gzip-compressed.")
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--inventory', action="append",
+                       help="path to inventory file (several inventories run the tests in shards).")
+    group.add_argument('--instance-name', dest="instance_name",
+                       help="base name for the instances (default: elliptics).")
+
+    parser.add_argument('--durations-db', dest="durations_db",
+                        default=os.path.join(ARTIFACTS_PATH, "durations.sqlite"),
+                        help="path to the database with tests' durations history.")
+    parser.add_argument('--fail-timing-out', action="store_true", dest="fail_timing_out",
+                        help="fail tests which timed out last time without running them.")
+    parser.add_argument('--max-failures', type=int, default=0, dest="max_failures",
+                        help="abort the run after the number of failed tests.")
+    parser.add_argument('--abort-on-setup-failure', action="append", dest="abort_setup_tags",
+                        metavar="TAG", help="abort the run only if setup of a test with the tag "
+                        "failed (by default any failed setup aborts the run).")
+    parser.add_argument('--pytest-timeout', type=int, default=None, dest="pytest_timeout",
+                        help="kill a pytest session running longer than the number of seconds.")
+    parser.add_argument('--pytest-max-rss', type=int, default=None, dest="pytest_max_rss",
+                        help="kill a pytest session using more resident memory (in MB).")
+    parser.add_argument('--shards', type=int, default=1, dest="shards",
+                        help="split the tests into shards running on separate cloud clusters.")
 
     args = parser.parse_args()
+    if not (args.list_tests or args.inventory or args.instance_name):
+        parser.error("one of the arguments --inventory --instance-name is required")
+    if args.shards < 1:
+        parser.error("--shards must be positive")
+    if args.inventory and args.shards > 1:
+        parser.error("--shards can't be used with --inventory (there is a shard per inventory)")
+    if args.spare_instances and not args.warm_pool:
+        parser.error("--spare-instances requires --warm-pool (spare instances are deleted otherwise)")
+    args.instance_name = args.instance_name or "elliptics"
 
     sys.exit(main(args))